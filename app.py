@@ -1,72 +1,334 @@
+import hashlib
+import itertools
+import json
+import math
 import os
+import time
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+
+from flask import (
+    Blueprint, Flask, current_app, render_template, stream_template, request,
+    flash, redirect, make_response, session, g, abort, url_for, jsonify,
+)
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UpdateUserForm, RedirectForm
-from models import db, connect_db, User, Message
+from models import (
+    db, User, Message, Like, Follows, TimelineEntry, delete_returning)
+from hashing import HashingPool, password_hasher, PoolSaturated
+from throttle import login_throttle
+from fragments import FragmentCache, fragment_cache
+from cache import Cache, cache
+from likebuffer import LikeBuffer, like_buffer
+from pagination import encode_cursor, decode_cursor, InvalidCursor
+from config import PROFILES
+import bulkload
+import migrations
+import routing
+import querystats
+from search import search_users, search_messages
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+TIMELINE_PAGE_SIZE = 100
+USERS_PAGE_SIZE = 24
+MESSAGE_SEARCH_PAGE_SIZE = 20
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+# Long list pages are streamed to the browser as they render, fetching rows
+# from a server-side cursor this many at a time.
+STREAM_BATCH_SIZE = 100
+
+bp = Blueprint('warbler', __name__, cli_group=None)
+
+
+def create_app(config=None):
+    """Make a Warbler app with the `config` profile (see config.py).
+
+    `config` is a profile name or a config object; None reads the name from
+    WARBLER_CONFIG, defaulting to development. Nothing here connects to the
+    database or creates tables, so a `gunicorn --preload` master can build
+    the app once and fork workers from it.
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'development')
+    if isinstance(config, str):
+        config = PROFILES[config]()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if app.config['TRUSTED_PROXY_HOPS']:
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'])
+
+    db.init_app(app)
+    routing.init_app(app)
+    querystats.init_app(app)
+    # Each app gets its own instance of these, kept in app.extensions
+    HashingPool().init_app(app)
+    login_throttle.init_app(app)
+    FragmentCache().init_app(app)
+    LikeBuffer().init_app(app)
+    Cache().init_app(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        DebugToolbarExtension(app)
+
+    app.register_blueprint(bp)
+
+    return app
 
-app = Flask(__name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
-app.config['WTF_CSRF_ENABLED'] = False
+def __getattr__(name):
+    """Build `app` (for `flask run`, scripts and the tests) on first use."""
 
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
 
-connect_db(app)
-db.create_all()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+##############################################################################
+# Maintenance commands
+
+
+@bp.cli.command('migrate')
+def migrate():
+    """Apply any pending schema migrations (see migrations.py)."""
+
+    migrations.upgrade(db.engine)
+    print("Schema is up to date.")
+
+
+@bp.cli.command('bulk-load')
+@click.option('--users', type=click.Path(exists=True, dir_okay=False))
+@click.option('--messages', type=click.Path(exists=True, dir_okay=False))
+@click.option('--follows', type=click.Path(exists=True, dir_okay=False))
+@click.option('--likes', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=bulkload.CHUNK_SIZE, show_default=True,
+              help="Rows per transaction.")
+def bulk_load(chunk_size, **paths):
+    """Load users, messages, follows and likes from CSV files."""
+
+    bulkload.load_csvs(
+        {table: path for table, path in paths.items() if path},
+        chunk_size=chunk_size,
+    )
+    print("Load complete.")
+
+
+@bp.cli.command('repair-counters')
+def repair_counters():
+    """Recompute every user's denormalized message/follow/like counters."""
+
+    User.recount()
+    db.session.commit()
+    print("Counters repaired.")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user comes from the cache (see User.get_cached), so most requests
+    don't touch the users table; the row is only read if a view needs the
+    password hash, and profile edits, signup and account deletion
+    invalidate the cached copy.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.get_cached(
+            session[CURR_USER_KEY], ttl=current_app.config['CURRENT_USER_CACHE_TTL'])
 
     else:
         g.user = None
 
-@app.before_request
+@bp.before_app_request
 def add_csrf_form_to_all_pages():
     """Before every route, add CSRF-only form to global object."""
 
     g.csrf_form = CSRFProtectForm()
     # print("CSRF Token:", g.csrf_form.csrf_token._value())
 
-@app.before_request
+@bp.before_app_request
 def add_redirect_form_to_all_pages():
     """ Before every route, add a hidden form that will
     have that routes location for the sake of redirects """
 
     g.redirect_form = RedirectForm()
 
-@app.before_request
-def create_user_likes():
-    """ Before every route, populate a list of messages that the user
-    likes """
+def memoized_lookup(name, ids, fetch):
+    """Which of `ids` does `fetch` say yes to, caching answers on g.
 
-    if CURR_USER_KEY in session:
-        g.user_liked_messages = {message.id for message in g.user.liked_messages} #g.user.liked_message_ids
-    else:
-        g.user_liked_messages = None
+    `fetch` takes a list of ids and returns the set that match. Only ids
+    not already answered during this request are passed to it.
+    """
+
+    known = g.setdefault(name, {})
+    unknown = [id for id in ids if id not in known]
+
+    if unknown:
+        matched = fetch(unknown)
+        known.update((id, id in matched) for id in unknown)
+
+    return {id for id in ids if known[id]}
+
+
+def pending_likes():
+    """This session's recent likes and unlikes, {message_id: liked}.
+
+    Clicks reach the database in batches (see likebuffer.py), so the
+    session remembers them for LIKE_OVERLAY_SECONDS and pages overlay them
+    on what the database says; the user sees their own clicks whichever
+    worker they land on.
+    """
+
+    cutoff = time.time() - current_app.config['LIKE_OVERLAY_SECONDS']
+
+    return {
+        int(message_id): liked
+        for message_id, (liked, at) in session.get('pending_likes', {}).items()
+        if at > cutoff
+    }
+
+
+def remember_like(message_id, liked):
+    """Add a like (or unlike) click to the session's `pending_likes`."""
+
+    now = time.time()
+    cutoff = now - current_app.config['LIKE_OVERLAY_SECONDS']
+
+    # Session keys are strings once the cookie has been round-tripped
+    recent = {
+        id: [was_liked, at]
+        for id, (was_liked, at) in session.get('pending_likes', {}).items()
+        if at > cutoff
+    }
+    recent[str(message_id)] = [liked, now]
+    session['pending_likes'] = recent
+
+
+def viewer_liked_ids(message_ids):
+    """Which of `message_ids` has the current user liked, as far as they
+    know: the database's answer with their pending clicks applied."""
+
+    liked = g.user.liked_message_ids(message_ids)
+
+    for message_id, now_liked in pending_likes().items():
+        if now_liked and message_id in message_ids:
+            liked.add(message_id)
+        elif not now_liked:
+            liked.discard(message_id)
+
+    return liked
+
+
+def unflushed_likes():
+    """The current user's pending clicks that the database doesn't show
+    yet, as (liked_ids, unliked_ids).
+
+    Costs one id-only query, and only while the session has clicks pending.
+    """
+
+    pending = pending_likes()
+    if not pending:
+        return set(), set()
+
+    in_db = g.user.liked_message_ids(list(pending))
+
+    return (
+        {id for id, liked in pending.items() if liked and id not in in_db},
+        {id for id, liked in pending.items() if not liked and id in in_db},
+    )
+
+
+@bp.app_template_global()
+def likes_count(user):
+    """`user`'s likes count; for the current user, with their clicks still
+    waiting in the like buffer counted in."""
+
+    if not g.user or user.id != g.user.id:
+        return user.likes_count
+
+    liked, unliked = unflushed_likes()
+    return user.likes_count + len(liked) - len(unliked)
+
+
+@bp.app_template_global()
+def liked_message_ids(messages):
+    """Ids of the `messages` that the current user has liked.
+
+    Only called by templates that render like buttons, so the lookup is
+    one id-only query for the messages on the page. Answers are memoized
+    for the rest of the request.
+    """
+
+    if not g.user:
+        return set()
+
+    return memoized_lookup(
+        'liked_message_ids',
+        [msg.id for msg in messages],
+        viewer_liked_ids,
+    )
+
+
+@bp.app_template_global()
+def followed_user_ids(users):
+    """Ids of the `users` that the current user is following.
+
+    Lets templates render follow/unfollow buttons for a whole list of users
+    with one query. Answers are memoized for the rest of the request.
+    """
+
+    if not g.user:
+        return set()
+
+    return memoized_lookup(
+        'followed_user_ids',
+        [user.id for user in users],
+        g.user.following_ids,
+    )
+
+
+@bp.app_template_global()
+def message_fragment(message):
+    """The viewer-independent part of a message's list item, cached.
+
+    Keyed by the message (whose text never changes; the timestamp is there
+    because SQLite reuses a deleted message's id) and the author fields the
+    fragment shows, so it is re-rendered after a profile edit but not after
+    writes to the author's counters (which bump updated_at).
+    """
+
+    author = message.user
+
+    return fragment_cache.get_or_render(
+        ('message', message.id, message.timestamp,
+         author.username, author.image_url),
+        lambda: render_template(
+            'messages/_message_fragment.html', msg=message),
+    )
 
 
 def do_login(user):
@@ -82,8 +344,75 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+##############################################################################
+# HTTP caching
+#
+# Static files are linked with a content fingerprint (?v=...) and cached
+# forever. A few busy pages carry a weak ETag built from version stamps that
+# are cheap to read, so a browser revalidating an unchanged page gets a 304
+# without the page being rendered.
+
+# Fingerprinted static files never change under the same URL
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Pages embed signed CSRF tokens that expire (WTF_CSRF_TIME_LIMIT, an hour
+# by default), so cached copies are retired after this many seconds.
+ETAG_WINDOW = 30 * 60
+
+_static_fingerprints = {}
 
-@app.route('/signup', methods=["GET", "POST"])
+
+@bp.app_template_global()
+def static_url(filename):
+    """URL for a static file, fingerprinted with a hash of its contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.stat(path).st_mtime
+
+    cached = _static_fingerprints.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:12]
+        cached = _static_fingerprints[filename] = (mtime, digest)
+
+    return url_for('static', filename=filename, v=cached[1])
+
+
+def viewer_stamp():
+    """Version stamp for the parts of a page that depend on who's looking.
+
+    updated_at changes with every write to the user's row, counters
+    included, so it covers their follows and likes as well as the profile;
+    likes not yet flushed to the database are covered by `pending_likes`.
+    """
+
+    return (
+        g.user.id,
+        g.user.updated_at.isoformat(),
+        g.user.following_count,
+        g.user.likes_count,
+        sorted(pending_likes().items()),
+    )
+
+
+def not_modified(*stamps):
+    """Is the client's copy of this page (identified by `stamps`) current?
+
+    Sets the page's ETag for `add_header` to send either way. Pages with
+    flashed messages waiting are never reported as unchanged.
+    """
+
+    key = repr((request.path, viewer_stamp(), int(time.time() // ETAG_WINDOW),
+                stamps))
+    g.etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    return (
+        '_flashes' not in session
+        and request.if_none_match.contains_weak(g.etag)
+    )
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -123,7 +452,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-# @app.route('/login', methods=["GET", "POST"])
+# @bp.route('/login', methods=["GET", "POST"])
 # def login():
 #     """Handle user login and redirect to homepage on success."""
 
@@ -146,7 +475,7 @@ def signup():
 #     print("I have entered the get portion of the login route")
 #     return render_template('users/login.html', form=form)
 
-@app.get('/login')
+@bp.get('/login')
 def show_login_form():
     """Show the login form."""
 
@@ -154,7 +483,7 @@ def show_login_form():
     form = LoginForm()
     return render_template('users/login.html', form=form)
 
-@app.post('/login')
+@bp.post('/login')
 def handle_login_form():
     """Handle the login form submission."""
 
@@ -165,11 +494,25 @@ def handle_login_form():
     if form.validate_on_submit():
         
         print("I have validated_on_submit")
+
+        # Throttle before paying for a bcrypt check
+        retry_after = login_throttle.check(
+            request.remote_addr, form.username.data)
+        if retry_after:
+            flash("Too many login attempts. Please try again later.", 'danger')
+            return (
+                render_template('users/login.html', form=form),
+                429,
+                {'Retry-After': str(math.ceil(retry_after))},
+            )
+
         user = User.authenticate(
             form.username.data,
             form.password.data)
 
         if user:
+            # Saves the password's new hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -182,7 +525,7 @@ def handle_login_form():
 
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -199,11 +542,13 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Browses users in username order, a page at a time (?after=<username>).
+    Can take a 'q' param in querystring to search by that username; search
+    results are ranked and paged with 'page'.
     """
 
     if not g.user:
@@ -211,16 +556,37 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    prev_url = next_url = None
 
     if not search:
-        users = User.query.all()
+        users, has_more = User.directory_page(
+            after=request.args.get('after'),
+            limit=USERS_PAGE_SIZE,
+        )
+        if has_more:
+            next_url = url_for('.list_users', after=users[-1].username)
+
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, has_more = search_users(
+            search,
+            page=page,
+            per_page=USERS_PAGE_SIZE,
+        )
+        if page > 1:
+            prev_url = url_for('.list_users', q=search, page=page - 1)
+        if has_more:
+            next_url = url_for('.list_users', q=search, page=page + 1)
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=users,
+        prev_url=prev_url,
+        next_url=next_url,
+    )
 
 
-@app.get('/users/<int:user_id>')
+@bp.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
 
@@ -229,12 +595,31 @@ def show_user(user_id):
         return redirect("/")
 
     g.redirect_form.redirect_location.data = f'/users/{user_id}'
-    user = User.query.get_or_404(user_id)
-
-    return render_template('users/show.html', user=user)
-
-
-@app.get('/users/<int:user_id>/following')
+    user = User.get_cached(user_id) or abort(404)
+
+    if not_modified(
+            user.updated_at.isoformat(),
+            user.messages_count,
+            user.followers_count,
+            user.following_count,
+            user.likes_count):
+        return '', 304
+
+    messages = (Message
+                .query
+                .filter(Message.user_id == user.id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .yield_per(STREAM_BATCH_SIZE))
+
+    return stream_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        batch_size=STREAM_BATCH_SIZE,
+    )
+
+
+@bp.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -242,11 +627,22 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_cached(user_id) or abort(404)
+    following = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user.id)
+                 .yield_per(STREAM_BATCH_SIZE))
+
+    return stream_template(
+        'users/following.html',
+        user=user,
+        following=following,
+        batch_size=STREAM_BATCH_SIZE,
+    )
 
 
-@app.get('/users/<int:user_id>/followers')
+@bp.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -254,47 +650,80 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_cached(user_id) or abort(404)
+    followers = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user.id)
+                 .yield_per(STREAM_BATCH_SIZE))
 
+    return stream_template(
+        'users/followers.html',
+        user=user,
+        followers=followers,
+        batch_size=STREAM_BATCH_SIZE,
+    )
 
-@app.post('/users/follow/<int:follow_id>')
+
+@bp.post('/users/follow/<int:follow_id>')
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
-    Redirect to following page for the current for the current user.
+    Following someone already followed is a no-op, so retried submits are
+    harmless. Redirect to following page for the current for the current user.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}/following")
+
+    try:
+        followed = Follows.follow(g.user.id, follow_id)
+    except IntegrityError:
+        # No such user
+        db.session.rollback()
+        abort(404)
+
+    if followed:
+        TimelineEntry.backfill(g.user.id, follow_id, limit=TIMELINE_PAGE_SIZE)
+        User.adjust_counts(g.user.id, following_count=1)
+        User.adjust_counts(follow_id, followers_count=1)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
-    Redirect to following page for the current for the current user.
+    Unfollowing someone not followed (or not there) is a no-op, so retried
+    submits are harmless. Redirect to following page for the current for the
+    current user.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if follow_id == g.user.id:
+        flash("You can't unfollow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}/following")
+
+    if Follows.unfollow(g.user.id, follow_id):
+        TimelineEntry.prune(g.user.id, follow_id)
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(follow_id, followers_count=-1)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -329,7 +758,7 @@ def profile():
     return render_template('/users/edit.html', form=form)
 
 
-@app.post('/users/delete')
+@bp.post('/users/delete')
 def delete_user():
     """Delete user.
 
@@ -345,7 +774,18 @@ def delete_user():
     if form.validate_on_submit():
         do_logout()
 
+        # Everyone whose counters include this user needs a recount
+        followers = db.session.query(Follows.user_following_id).filter(
+            Follows.user_being_followed_id == g.user.id)
+        following = db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == g.user.id)
+        likers = db.session.query(Like.user_id).join(Message).filter(
+            Message.user_id == g.user.id)
+        affected_ids = {
+            user_id for (user_id,) in followers.union(following, likers)}
+
         User.query.filter(User.id == g.user.id).delete()
+        User.recount(affected_ids - {g.user.id})
         db.session.commit()
 
         flash('User successfully deleted :(', 'success')
@@ -355,7 +795,7 @@ def delete_user():
     return redirect('/')
 
 
-@app.get('/users/<int:user_id>/likes')
+@bp.get('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
     """ Show liked messages of user """
 
@@ -364,15 +804,40 @@ def show_liked_messages(user_id):
         return redirect("/")
 
     g.redirect_form.redirect_location.data = f'/users/{user_id}/likes'
-    user = User.query.get_or_404(user_id)
-
-    return render_template('users/liked.html', messages=user.liked_messages)
+    user = User.get_cached(user_id) or abort(404)
+    messages = (Message
+                .query
+                .join(Like)
+                .filter(Like.user_id == user.id)
+                .options(joinedload(Message.user)))
+
+    added = []
+
+    if user.id == g.user.id:
+        # Their own list shows the clicks the like buffer hasn't written yet
+        liked, unliked = unflushed_likes()
+
+        if unliked:
+            messages = messages.filter(Message.id.notin_(unliked))
+        if liked:
+            added = (Message
+                     .query
+                     .filter(Message.id.in_(liked))
+                     .options(joinedload(Message.user))
+                     .all())
+
+    return stream_template(
+        'users/liked.html',
+        messages=itertools.chain(
+            added, messages.yield_per(STREAM_BATCH_SIZE)),
+        batch_size=STREAM_BATCH_SIZE,
+    )
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """Add a message:
 
@@ -387,7 +852,11 @@ def add_message():
 
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
+        msg.index_for_search()
         g.user.messages.append(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -395,7 +864,40 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@bp.get('/messages/search')
+def search_messages_page():
+    """Search messages by text.
+
+    Takes the search in 'q'; further pages of results via ?before=<cursor>.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    g.redirect_form.redirect_location.data = request.full_path
+    search = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+
+    if search:
+        try:
+            messages, next_cursor = search_messages(
+                search,
+                cursor=request.args.get('before'),
+                per_page=MESSAGE_SEARCH_PAGE_SIZE,
+            )
+        except InvalidCursor:
+            abort(400)
+
+    return render_template(
+        'messages/search.html',
+        messages=messages,
+        search=search,
+        next_cursor=next_cursor,
+    )
+
+
+@bp.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
@@ -405,10 +907,14 @@ def show_message(message_id):
 
     g.redirect_form.redirect_location.data = f'/messages/{message_id}'
     msg = Message.query.get_or_404(message_id)
+
+    if not_modified(msg.id, msg.user.updated_at.isoformat()):
+        return '', 304
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@bp.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -426,7 +932,13 @@ def delete_message(message_id):
         msg = Message.query.get_or_404(message_id)
 
         if g.user.id == msg.user_id:
+            # Timeline entries and the message's search document are
+            # removed along with the row (ON DELETE CASCADE / GIN index)
+            liker_ids = delete_returning(
+                Like, Like.message_id == msg.id, Like.user_id)
             db.session.delete(msg)
+            User.adjust_counts(g.user.id, messages_count=-1)
+            User.adjust_likes_counts({user_id: -1 for user_id in liker_ids})
             db.session.commit()
 
             flash('Message successfully deleted.', 'success')
@@ -434,7 +946,7 @@ def delete_message(message_id):
     flash("Access unauthorized.", "danger")
     return redirect(f'/messages/{message_id}')
 
-@app.post('/messages/<int:message_id>/like')
+@bp.post('/messages/<int:message_id>/like')
 def like_message(message_id):
     """ like message by user """
 
@@ -445,13 +957,13 @@ def like_message(message_id):
     form = g.redirect_form
 
     if form.validate_on_submit():
-        msg = Message.query.get_or_404(message_id)
-        msg.likers.append(g.user)
-        db.session.commit()
+        like_buffer.record(g.user.id, message_id, True)
+        routing.pin_to_primary()
+        remember_like(message_id, True)
 
     return redirect(form.redirect_location.data)
 
-@app.post('/messages/<int:message_id>/unlike')
+@bp.post('/messages/<int:message_id>/unlike')
 def unlike_message(message_id):
     """ unlike message by user """
 
@@ -462,9 +974,9 @@ def unlike_message(message_id):
     form = g.redirect_form
 
     if form.validate_on_submit():
-        msg = Message.query.get_or_404(message_id)
-        msg.likers.remove(g.user)
-        db.session.commit()
+        like_buffer.record(g.user.id, message_id, False)
+        routing.pin_to_primary()
+        remember_like(message_id, False)
 
     return redirect(form.redirect_location.data)
 
@@ -473,43 +985,288 @@ def unlike_message(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+def get_timeline_page():
+    """Get a page of the current user's timeline from the ?before= cursor.
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+
+    before = request.args.get('before')
+
+    try:
+        before = decode_cursor(before) if before else None
+    except InvalidCursor:
+        abort(400)
+
+    messages, has_more = TimelineEntry.messages_for(
+        g.user.id,
+        limit=TIMELINE_PAGE_SIZE,
+        before=before,
+    )
+
+    next_cursor = None
+    if has_more:
+        last = messages[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return messages, next_cursor
+
+
+@bp.get('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from the
+      user's materialized timeline; older pages via ?before=<cursor>
     """
 
     if g.user:
         g.redirect_form.redirect_location.data = '/'
 
-        users = g.user.following + [g.user]
-        user_ids = [user.id for user in users]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if not_modified(request.args.get('before'),
+                        *TimelineEntry.version(g.user.id)):
+            return '', 304
 
-        return render_template('home.html', messages=messages)
+        messages, next_cursor = get_timeline_page()
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            next_cursor=next_cursor,
+        )
 
     else:
         return render_template('home-anon.html')
 
 
+@bp.get('/timeline')
+def timeline_fragment():
+    """Render the next page of the home timeline as bare <li> items.
+
+    Used by the "load more" button on the home page. The cursor for the
+    page after this one is sent in the X-Next-Cursor header.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    g.redirect_form.redirect_location.data = '/'
+
+    messages, next_cursor = get_timeline_page()
+
+    response = make_response(
+        render_template('messages/_timeline_items.html', messages=messages))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+
+@bp.app_errorhandler(PoolSaturated)
+def hashing_pool_saturated(error):
+    """Shed password work instead of queueing it when the pool is full."""
+
+    return (
+        "Too many sign-ins in progress; please try again in a moment.",
+        503,
+        {'Retry-After': '1'},
+    )
+
+
+@bp.get('/metrics/hashing')
+def hashing_metrics():
+    """Queue depth and throughput of this worker's password hashing pool.
+
+    Only answered for requests from the local machine.
+    """
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return jsonify(password_hasher.stats())
+
+
+@bp.get('/metrics/likes')
+def like_buffer_metrics():
+    """Backlog and throughput of this worker's like buffer.
+
+    Only answered for requests from the local machine.
+    """
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return jsonify(like_buffer.stats())
+
+
+@bp.get('/metrics/cache')
+def cache_metrics():
+    """Hits, misses and hit rate of each cached lookup in this worker.
+
+    Only answered for requests from the local machine.
+    """
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return jsonify(cache.stats())
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# JSON API
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Read-only endpoints for the mobile client. Responses are built from column
+# projections (no ORM objects) and serialized with orjson where it's
+# installed. Lists are newest first and paged with ?before=<next_cursor>;
+# ?limit= sets the page size, up to API_MAX_PAGE_SIZE.
+
+
+def api_response(data, status=200):
+    """Serialize `data` as a compact JSON response."""
+
+    if orjson:
+        body = orjson.dumps(data)
+    else:
+        body = json.dumps(data, separators=(',', ':'))
+
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+
+def api_error(status, message):
+    return api_response({'error': message}, status)
+
+
+def message_json(row, liked_ids):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+        'liked': row.id in liked_ids,
+    }
+
+
+def api_message_page(select, timestamp, message_id):
+    """Respond with a page of `select`'s rows, newest first.
+
+    `timestamp` and `message_id` are the columns the keyset cursor covers;
+    there should be an index to match.
+    """
+
+    try:
+        before = request.args.get('before')
+        before = decode_cursor(before) if before else None
+    except InvalidCursor:
+        return api_error(400, "Invalid cursor.")
+
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, API_MAX_PAGE_SIZE))
+
+    if before:
+        select = select.where(
+            db.tuple_(timestamp, message_id) < db.tuple_(*before))
+
+    rows = db.session.execute(
+        select.order_by(timestamp.desc(), message_id.desc()).limit(limit + 1)
+    ).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
 
-@app.after_request
+    liked_ids = viewer_liked_ids([row.id for row in rows])
+
+    return api_response({
+        'messages': [message_json(row, liked_ids) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+@bp.get('/api/v1/timeline')
+def api_timeline():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        return api_error(401, "Not logged in.")
+
+    return api_message_page(
+        Message.feed_select()
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .where(TimelineEntry.user_id == g.user.id),
+        TimelineEntry.timestamp,
+        TimelineEntry.message_id,
+    )
+
+
+@bp.get('/api/v1/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """Messages written by a user."""
+
+    if not g.user:
+        return api_error(401, "Not logged in.")
+
+    if not User.get_cached(user_id):
+        return api_error(404, "No such user.")
+
+    return api_message_page(
+        Message.feed_select().where(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+    )
+
+
+@bp.get('/api/v1/messages/<int:message_id>')
+def api_message(message_id):
+    """A single message."""
+
+    if not g.user:
+        return api_error(401, "Not logged in.")
+
+    row = db.session.execute(
+        Message.feed_select().where(Message.id == message_id)).first()
+
+    if not row:
+        return api_error(404, "No such message.")
+
+    return api_response(
+        message_json(row, viewer_liked_ids([message_id])))
+
+
+##############################################################################
+# Caching policy (see "HTTP caching" above)
+
+@bp.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Set each response's caching policy.
+
+    - fingerprinted static files: cached for a year, never revalidated
+    - pages that set an ETag: kept, but revalidated on every use
+    - everything else: not stored
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if request.endpoint == 'static':
+        if 'v' in request.args:
+            # send_static_file asks for revalidation (no-cache); these
+            # URLs never change, so that's dropped
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+    elif 'etag' in g:
+        response.set_etag(g.etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        response.cache_control.no_store = True
+
     return response
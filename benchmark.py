@@ -0,0 +1,234 @@
+"""Compare gunicorn's worker classes (see gunicorn.conf.py) on Warbler's pages.
+
+For each mode this starts gunicorn with the benchmark profile (config.py)
+on a spare port. It then requests each route from CONCURRENCY client
+threads for DURATION seconds, as a logged-in user, and prints throughput
+and latency percentiles. Run it against a seeded database, with CACHE_URL
+pointing at a Redis server as in production:
+
+    python seed.py
+    python benchmark.py --modes gthread gevent --concurrency 32 --duration 10
+
+The user is the one following the most people, so the home timeline is as
+busy as the data allows. Clients log in with a signed session cookie rather
+than the login form, so bcrypt doesn't dominate every mode alike. Modes
+whose worker class isn't installed are skipped.
+"""
+
+import argparse
+import http.client
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from app import create_app, CURR_USER_KEY
+from models import User, Message
+
+MODES = ('sync', 'gthread', 'gevent')
+
+ROUTES = (
+    '/',
+    '/users',
+    '/users/{user_id}',
+    '/users/{user_id}/followers',
+    '/messages/{message_id}',
+    '/api/v1/timeline',
+    '/api/v1/users/{user_id}/messages',
+)
+
+# Modes that need more than gunicorn itself
+MODE_REQUIREMENTS = {'gevent': 'gevent'}
+
+
+def session_cookie(app, user_id):
+    """A Cookie header value for a session logged in as `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+    return f"{app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def pick_targets(app):
+    """Ids to fill the routes in with: a busy user and one of their messages."""
+
+    with app.app_context():
+        user = User.query.order_by(User.following_count.desc()).first()
+        if user is None:
+            sys.exit("The database has no users; run seed.py first.")
+
+        message = (Message.query.filter(Message.user_id == user.id).first()
+                   or Message.query.first())
+        if message is None:
+            sys.exit("The database has no messages; run seed.py first.")
+
+        return user.id, message.id
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, workers=None):
+    """Start gunicorn in `mode`, returning once it accepts connections."""
+
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=mode, PORT=str(port))
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gunicorn',
+            '--config', 'gunicorn.conf.py',
+            '--access-logfile', os.devnull,
+            '--log-level', 'warning',
+            'app:create_app("benchmark")',
+        ],
+        env=env,
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"gunicorn ({mode}) exited with status {server.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    sys.exit(f"gunicorn ({mode}) didn't start listening within 30 seconds")
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait(timeout=60)
+
+
+def load(port, path, cookie, concurrency, duration):
+    """GET `path` from `concurrency` threads for `duration` seconds.
+
+    Returns (latencies of the 200 responses in seconds, failures, elapsed).
+    """
+
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    headers = {'Cookie': cookie}
+    deadline = time.monotonic() + duration
+
+    def client():
+        nonlocal failures
+
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        mine = []
+        failed = 0
+
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                ok = False
+
+            if ok:
+                mine.append(time.perf_counter() - start)
+            else:
+                failed += 1
+
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            failures += failed
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    return latencies, failures, time.monotonic() - started
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def benchmark_mode(mode, paths, cookie, args):
+    port = free_port()
+    server = start_server(mode, port, args.workers)
+
+    try:
+        results = []
+        for path in paths:
+            # Warm up: fill the caches and open the database connections
+            load(port, path, cookie, args.concurrency, 1)
+
+            latencies, failures, elapsed = load(
+                port, path, cookie, args.concurrency, args.duration)
+            latencies.sort()
+            results.append((
+                path,
+                len(latencies) / elapsed,
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                failures,
+            ))
+        return results
+
+    finally:
+        stop_server(server)
+
+
+def print_results(mode, results):
+    print(f"\n{mode}")
+    print(f"{'route':<36} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>7}")
+    for path, rate, p50, p95, p99, failures in results:
+        print(f"{path:<36} {rate:>8.1f} {p50:>8.1f} {p95:>8.1f} "
+              f"{p99:>8.1f} {failures:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds per route")
+    parser.add_argument('--workers', type=int,
+                        help="gunicorn workers (default: gunicorn.conf.py's)")
+    args = parser.parse_args()
+
+    app = create_app('benchmark')
+    user_id, message_id = pick_targets(app)
+    cookie = session_cookie(app, user_id)
+    paths = [
+        route.format(user_id=user_id, message_id=message_id)
+        for route in ROUTES
+    ]
+
+    for mode in args.modes:
+        requirement = MODE_REQUIREMENTS.get(mode)
+        if requirement and not importlib.util.find_spec(requirement):
+            print(f"\n{mode}: skipped ({requirement} isn't installed)")
+            continue
+
+        print_results(mode, benchmark_mode(mode, paths, cookie, args))
+
+
+if __name__ == '__main__':
+    main()
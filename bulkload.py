@@ -0,0 +1,303 @@
+"""Bulk loading of users, messages, follows and likes from CSV files.
+
+Each file's header row names the table columns it holds; columns left out
+take their defaults, and empty fields are NULL. Rows are appended to
+whatever the tables already contain. Run it with:
+
+    flask --app app bulk-load --users users.csv --messages messages.csv ...
+
+(seed.py loads the sample data in generator/ this way.)
+
+On Postgres the rows are streamed in with COPY FROM STDIN, CHUNK_SIZE rows
+per transaction, so memory use is bounded however big the files are. The
+tables' secondary indexes are dropped for the load and rebuilt once at the
+end, which is far cheaper than updating them row by row; primary keys and
+unique constraints stay in place. Other backends get batched INSERTs with
+the indexes left alone.
+
+Afterwards the id sequences are moved past the loaded ids, search documents
+are computed, and the timelines and counters that the write paths normally
+maintain are rebuilt, REBUILD_CHUNK_SIZE users per transaction. As when
+following someone in the app, a timeline gets each followed user's newest
+page of messages rather than their whole history.
+"""
+
+import csv
+import io
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import text
+
+from models import db, User, TimelineEntry
+from migrations import backfill_search_vectors
+
+CHUNK_SIZE = 50000
+
+# Users whose timelines and counters are rebuilt per transaction
+REBUILD_CHUNK_SIZE = 1000
+
+# Parents before children, for the foreign keys
+LOAD_ORDER = ('users', 'messages', 'follows', 'likes')
+
+
+def load_csvs(paths, chunk_size=CHUNK_SIZE, echo=print):
+    """Load CSV files into their tables, then rebuild derived data.
+
+    `paths` maps table names (see LOAD_ORDER) to CSV files.
+    """
+
+    unknown = set(paths) - set(LOAD_ORDER)
+    if unknown:
+        raise ValueError(f"Can't bulk load {', '.join(sorted(unknown))}")
+
+    engine = db.engine
+    tables = [db.metadata.tables[name] for name in LOAD_ORDER if name in paths]
+
+    dropped = drop_indexes(engine, [table.name for table in tables])
+
+    try:
+        for table in tables:
+            with open(paths[table.name], newline='') as f:
+                load_csv(engine, table, f, chunk_size, echo)
+
+        reset_sequences(engine, tables)
+
+        echo("Computing search documents")
+        backfill_search_vectors(engine)
+
+    finally:
+        # Even after a failure, so the tables aren't left unindexed
+        recreate_indexes(engine, dropped, echo)
+
+    # The rebuild looks up each user's follows and newest messages through
+    # the indexes just rebuilt; the timelines' own are a load of their own
+    dropped = drop_indexes(engine, ['timeline_entries'])
+
+    try:
+        echo("Rebuilding timelines and counters")
+        rebuild_derived(echo=echo)
+
+    except Exception:
+        # Release the session's locks, which rebuilding the indexes waits on
+        db.session.rollback()
+        raise
+
+    finally:
+        recreate_indexes(engine, dropped, echo)
+
+    analyze(engine, [table.name for table in tables] + ['timeline_entries'])
+
+
+def rebuild_derived(chunk_size=REBUILD_CHUNK_SIZE, limit=100, echo=print):
+    """Rebuild every user's timeline and counters, `chunk_size` users per
+    transaction, in id order.
+
+    Timelines get the newest `limit` messages of each followed user (see
+    TimelineEntry.rebuild).
+    """
+
+    last_id = 0
+    rebuilt = 0
+
+    while True:
+        user_ids = db.session.scalars(
+            db.select(User.id)
+            .where(User.id > last_id)
+            .order_by(User.id)
+            .limit(chunk_size)
+        ).all()
+        if not user_ids:
+            return
+
+        TimelineEntry.rebuild(user_ids, limit)
+        User.recount(user_ids)
+        db.session.commit()
+
+        last_id = user_ids[-1]
+        rebuilt += len(user_ids)
+        echo(f"timelines and counters: {rebuilt:,} users")
+
+
+def load_csv(engine, table, f, chunk_size=CHUNK_SIZE, echo=print):
+    """Append the rows of CSV file `f` to `table`."""
+
+    reader = csv.reader(f)
+    columns = next(reader, None)
+    if not columns:
+        return
+
+    missing = [name for name in columns if name not in table.columns]
+    if missing:
+        raise ValueError(
+            f"{table.name} has no column {', '.join(missing)}")
+
+    if engine.dialect.name == 'postgresql':
+        loaded_counts = copy_chunks(engine, table, columns, reader, chunk_size)
+    else:
+        loaded_counts = insert_chunks(
+            engine, table, columns, reader, chunk_size)
+
+    started = time.monotonic()
+    loaded = 0
+    for count in loaded_counts:
+        loaded += count
+        elapsed = time.monotonic() - started
+        echo(f"{table.name}: {loaded:,} rows "
+             f"({loaded / elapsed if elapsed else 0:,.0f} rows/s)")
+
+
+def chunks(rows, size):
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def copy_chunks(engine, table, columns, rows, chunk_size):
+    """COPY `rows` into `table`, committing every `chunk_size` rows.
+
+    Yields the number of rows in each chunk as it's committed.
+    """
+
+    # COPY skips Python-side column defaults, so they're filled in here
+    defaults = [
+        column for column in table.columns
+        if column.name not in columns
+        and column.default is not None
+        and not column.primary_key
+    ]
+
+    preparer = engine.dialect.identifier_preparer
+    names = [
+        preparer.quote(name)
+        for name in columns + [column.name for column in defaults]
+    ]
+    sql = (f"COPY {preparer.format_table(table)} ({', '.join(names)}) "
+           f"FROM STDIN WITH (FORMAT csv)")
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        for chunk in chunks(rows, chunk_size):
+            extra = [default_value(column) for column in defaults]
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in chunk:
+                writer.writerow(row + extra)
+            buffer.seek(0)
+
+            cursor.copy_expert(sql, buffer)
+            conn.commit()
+            yield len(chunk)
+
+    finally:
+        conn.close()
+
+
+def default_value(column):
+    if column.default.is_callable:
+        return column.default.arg(None)
+    return column.default.arg
+
+
+def insert_chunks(engine, table, columns, rows, chunk_size):
+    """INSERT `rows` into `table`, `chunk_size` rows per transaction.
+
+    Yields the number of rows in each chunk as it's committed.
+    """
+
+    cols = [table.columns[name] for name in columns]
+
+    for chunk in chunks(rows, chunk_size):
+        with engine.begin() as conn:
+            conn.execute(table.insert(), [
+                {col.name: parse_value(col, value)
+                 for col, value in zip(cols, row)}
+                for row in chunk
+            ])
+        yield len(chunk)
+
+
+def parse_value(column, value):
+    """A CSV field as the Python value `column` takes (COPY's rules)."""
+
+    if value == '':
+        return None
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    return value
+
+
+def drop_indexes(engine, table_names):
+    """Drop the secondary indexes on `table_names` (Postgres only).
+
+    Returns the dropped indexes' definitions, for `recreate_indexes`.
+    Indexes backing a constraint (primary keys, unique columns) are kept.
+    """
+
+    if engine.dialect.name != 'postgresql':
+        return []
+
+    with engine.begin() as conn:
+        indexes = conn.execute(text(
+            'SELECT i.indexname, i.indexdef FROM pg_indexes i '
+            'WHERE i.schemaname = current_schema() '
+            'AND i.tablename = ANY(:tables) '
+            'AND NOT EXISTS ('
+            '  SELECT 1 FROM pg_constraint c '
+            "  WHERE c.conindid = format('%I.%I', i.schemaname, i.indexname)"
+            '    ::regclass'
+            ')'
+        ), {'tables': list(table_names)}).all()
+
+        preparer = engine.dialect.identifier_preparer
+        for name, definition in indexes:
+            conn.execute(text(f'DROP INDEX {preparer.quote(name)}'))
+
+    return [definition for name, definition in indexes]
+
+
+def recreate_indexes(engine, definitions, echo=print):
+    for definition in definitions:
+        echo(definition)
+        with engine.begin() as conn:
+            conn.execute(text(definition))
+
+
+def reset_sequences(engine, tables):
+    """Move each table's id sequence past the highest id (Postgres only).
+
+    Needed when the files supply the ids themselves.
+    """
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as conn:
+        for table in tables:
+            if 'id' not in table.columns:
+                continue
+
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"coalesce(max(id), 1), max(id) IS NOT NULL) "
+                f"FROM {table.name}"
+            ))
+
+
+def analyze(engine, table_names):
+    """Refresh the planner's statistics for the reloaded tables."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as conn:
+        for name in table_names:
+            conn.execute(text(f'ANALYZE {name}'))
@@ -0,0 +1,269 @@
+"""Shared cache for data that's expensive to look up and read far more often
+than it changes.
+
+`cache` offers get/set/delete/incr with TTLs on top of one of two backends:
+
+- LocalBackend: an LRU dict in this process. Fine for one worker; with
+  several, each has its own copy and sees others' writes only after the TTL.
+- RedisBackend: any server speaking the Redis protocol, shared by every
+  worker. Values are pickled.
+
+Entries can be tagged. Invalidating a tag bumps a version counter stored in
+the cache itself, and entries saved under an older version are treated as
+misses, so one incr retires every entry carrying the tag.
+
+`cached()` is the read-through helper that views and models use. Each call
+names its call site, and hits and misses are counted per site (see
+`stats()`).
+
+Each app has a front end (and backend) of its own, kept in app.extensions
+by `init_app`; `cache` stands for the current app's.
+
+Configuration (read by `init_app`):
+
+- CACHE_URL: redis://... to use RedisBackend; unset for LocalBackend
+  (development and tests; the production profile requires it).
+- CACHE_DEFAULT_TTL: seconds entries live unless told otherwise.
+- CACHE_LOCAL_MAX_ENTRIES: LocalBackend's size.
+- CACHE_KEY_PREFIX: prepended to every key, to share a Redis database.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+
+class LocalBackend:
+    """Least-recently-used store in this process's memory."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                entry[0] if entry else None
+                for entry in (self._live(key, now) for key in keys)
+            ]
+
+    def set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, keys, delta):
+        now = time.monotonic()
+        with self._lock:
+            values = []
+            for key in keys:
+                entry = self._live(key, now)
+                value = (entry[0] if entry else 0) + delta
+                self._entries[key] = (value, entry[1] if entry else None)
+                self._entries.move_to_end(key)
+                values.append(value)
+            return values
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """Store in a Redis (or Redis-protocol) server, shared between workers.
+
+    Pass either `url`, or an already-built client (such as a
+    fakeredis.FakeRedis in tests).
+    """
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            # Only needed when a Redis cache is configured
+            import redis
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+
+    @staticmethod
+    def _load(raw):
+        if raw is None:
+            return None
+        # Counters (tag versions) are stored as plain integers so that INCR
+        # works on them
+        if raw.isdigit():
+            return int(raw)
+        return pickle.loads(raw)
+
+    def get_many(self, keys):
+        return [self._load(raw) for raw in self.client.mget(keys)]
+
+    def set(self, key, value, ttl):
+        self.client.set(
+            key,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            ex=ttl or None,
+        )
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, keys, delta):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.incrby(key, delta)
+        return pipe.execute()
+
+    def clear(self):
+        self.client.flushdb()
+
+
+class Cache:
+    """Cache front end: key prefixing, TTLs, tags and per-site stats."""
+
+    def __init__(self, backend=None, default_ttl=300, prefix='warbler:'):
+        self.backend = backend or LocalBackend()
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def init_app(self, app):
+        self.default_ttl = app.config.setdefault(
+            'CACHE_DEFAULT_TTL', self.default_ttl)
+        self.prefix = app.config.setdefault('CACHE_KEY_PREFIX', self.prefix)
+
+        url = app.config.setdefault('CACHE_URL', None)
+        if url:
+            self.backend = RedisBackend(url)
+        else:
+            self.backend = LocalBackend(app.config.setdefault(
+                'CACHE_LOCAL_MAX_ENTRIES', 10000))
+
+        app.extensions['cache'] = self
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def _tag_key(self, tag):
+        return self.prefix + 'tag:' + tag
+
+    # Plain key/value access
+
+    def get(self, key):
+        return self.backend.get_many([self._key(key)])[0]
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(self._key(key), value, ttl or self.default_ttl)
+
+    def delete(self, *keys):
+        self.backend.delete([self._key(key) for key in keys])
+
+    def incr(self, key, delta=1):
+        return self.backend.incr([self._key(key)], delta)[0]
+
+    def clear(self):
+        self.backend.clear()
+        with self._stats_lock:
+            self._stats.clear()
+
+    # Tagged, read-through access
+
+    def invalidate(self, *tags):
+        """Retire every entry cached under any of `tags`."""
+
+        if tags:
+            self.backend.incr([self._tag_key(tag) for tag in set(tags)], 1)
+
+    def tag_versions(self, *tags):
+        """The current versions of `tags`, which change whenever they are
+        invalidated; None for a tag never invalidated (or whose counter the
+        backend has evicted)."""
+
+        return self.backend.get_many([self._tag_key(tag) for tag in tags])
+
+    def cached(self, site, key, fetch, ttl=None, tags=()):
+        """The value for `key`, calling `fetch()` to produce it on a miss.
+
+        `site` names the caller for the hit/miss counts. `fetch` may return
+        None, which is cached like any other value.
+        """
+
+        tags = tuple(tags)
+        entry, *versions = self.backend.get_many(
+            [self._key(key)] + [self._tag_key(tag) for tag in tags])
+
+        # Entries are (tag versions when fetched, value)
+        hit = entry is not None and entry[0] == versions
+        self._count(site, hit)
+        if hit:
+            return entry[1]
+
+        # The versions were read before fetching, so an invalidation that
+        # lands mid-fetch leaves this entry already out of date
+        value = fetch()
+        self.backend.set(
+            self._key(key), (versions, value), ttl or self.default_ttl)
+        return value
+
+    def _count(self, site, hit):
+        with self._stats_lock:
+            counts = self._stats.setdefault(site, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] += 1
+
+    def stats(self):
+        """{site: {'hits', 'misses', 'hit_rate'}} for this process."""
+
+        with self._stats_lock:
+            return {
+                site: dict(
+                    counts,
+                    hit_rate=counts['hits'] / (counts['hits'] + counts['misses']),
+                )
+                for site, counts in self._stats.items()
+            }
+
+
+def invalidate_on_commit(session, *tags):
+    """Invalidate `tags` once `session`'s transaction ends.
+
+    Invalidating any earlier would let a concurrent request re-cache the old
+    rows before the new ones are committed. Tags are invalidated after a
+    rollback too, which costs a few misses but can never leave stale data.
+    """
+
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def flush_invalidations(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+cache = LocalProxy(lambda: current_app.extensions['cache'])
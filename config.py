@@ -0,0 +1,117 @@
+"""Configuration profiles for create_app (see app.py).
+
+Choose one by name, as in create_app('production'). The module-level `app`
+that `flask run` and the tests import uses the WARBLER_CONFIG environment
+variable, and falls back to development.
+
+Database URLs and the secret key are read from the environment when the
+app is created, not when this module is imported.
+"""
+
+import os
+import tempfile
+
+import routing
+
+
+def database_url(url):
+    """SQLAlchemy wants postgresql://, but Heroku-style URLs say postgres://."""
+
+    return url.strip().replace("postgres://", "postgresql://")
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    WTF_CSRF_ENABLED = False
+
+    DEBUG_TOOLBAR = False
+
+    # Proxies in front of the app that append to X-Forwarded-For; their
+    # entries are trusted for request.remote_addr (the login throttle's
+    # per-IP buckets). 0 uses the socket's peer address.
+    TRUSTED_PROXY_HOPS = 0
+
+    # Seconds the logged-in user's record is cached between writes; bounds
+    # how stale it can be in workers that don't share a cache (see cache.py)
+    CURRENT_USER_CACHE_TTL = 30
+
+    # Seconds a session overlays its own like clicks on the database's
+    # likes; comfortably longer than the like buffer takes to flush them
+    LIKE_OVERLAY_SECONDS = 30
+
+    def __init__(self):
+        self.SQLALCHEMY_DATABASE_URI = database_url(os.environ['DATABASE_URL'])
+        self.SECRET_KEY = os.environ['SECRET_KEY']
+
+        # Optional read replicas, as a comma-separated list of database
+        # URLs; GET requests read from them (see routing.py)
+        self.SQLALCHEMY_BINDS = {
+            f'{routing.REPLICA_BIND_PREFIX}{i}': database_url(url)
+            for i, url in enumerate(
+                os.environ.get('DATABASE_REPLICA_URLS', '').split(','))
+            if url.strip()
+        }
+
+        # redis://... for a cache shared by every worker; unset keeps it in
+        # this process (see cache.py)
+        self.CACHE_URL = os.environ.get('CACHE_URL')
+
+
+class DevelopmentConfig(Config):
+    """`flask run` on a laptop: the debug toolbar is on."""
+
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class ProductionConfig(Config):
+    """gunicorn: nothing that slows requests or touches the database at
+    startup, so workers can fork from a `--preload`ed master.
+
+    CACHE_URL is required: with several workers each keeping its own
+    cache, one worker's writes don't invalidate the others' entries, and
+    they go on serving stale timelines and 304s."""
+
+    # Heroku's router
+    TRUSTED_PROXY_HOPS = 1
+
+    def __init__(self):
+        super().__init__()
+        self.CACHE_URL = os.environ['CACHE_URL']
+        self.TRUSTED_PROXY_HOPS = int(os.environ.get(
+            'TRUSTED_PROXY_HOPS', self.TRUSTED_PROXY_HOPS))
+
+
+class TestConfig(Config):
+    """The unit tests: writes land before the request returns, and state
+    that outlives the process (the login throttle's table) goes in a
+    private temporary directory."""
+
+    TESTING = True
+    LIKE_BUFFER_FLUSH_INTERVAL = 0
+
+    def __init__(self):
+        super().__init__()
+        self.LOGIN_THROTTLE_PATH = os.path.join(
+            tempfile.mkdtemp(), 'login-throttle')
+
+
+class BenchmarkConfig(ProductionConfig):
+    """Load tests: production, minus the login throttle (every simulated
+    user logs in from one address) and the proxy in front of it, and with
+    per-request query stats in the response headers."""
+
+    LOGIN_THROTTLE_ENABLED = False
+    QUERY_STATS_HEADERS = True
+    TRUSTED_PROXY_HOPS = 0
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'test': TestConfig,
+    'benchmark': BenchmarkConfig,
+}
@@ -0,0 +1,82 @@
+"""In-process cache for rendered template fragments.
+
+Markup that's the same for every viewer (a warble's avatar, byline and
+text, say) is rendered once and reused until it's evicted. Keys should
+include a version for everything the fragment shows, so that a change
+produces a new key rather than needing an invalidation; stale versions
+simply age out.
+
+Eviction is least-recently-used, bounded by the total size of the cached
+markup rather than the number of entries: FRAGMENT_CACHE_MAX_BYTES
+(16MB by default, per process and app). Each app has a cache of its own,
+kept in app.extensions by `init_app`; `fragment_cache` stands for the
+current app's.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+
+
+class FragmentCache:
+    """LRU cache of rendered markup, capped at `max_bytes` of text."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get(
+            'FRAGMENT_CACHE_MAX_BYTES', self.max_bytes)
+        app.extensions['fragment_cache'] = self
+
+    def get_or_render(self, key, render):
+        """Cached markup for `key`, calling `render()` to make it if needed."""
+
+        with self._lock:
+            markup = self._entries.get(key)
+            if markup is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return markup
+            self.misses += 1
+
+        # Rendered outside the lock: two requests may race to render the
+        # same fragment, but neither waits on the other's template
+        markup = Markup(render())
+
+        with self._lock:
+            if key not in self._entries and len(markup) <= self.max_bytes:
+                self._entries[key] = markup
+                self.size += len(markup)
+
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+
+        return markup
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'])
@@ -0,0 +1,92 @@
+"""gunicorn settings for Warbler (gunicorn reads this file from the working
+directory; the Procfile also names it).
+
+Worker model, set with GUNICORN_WORKER_CLASS:
+
+- gthread (default): a process per CPU, each with GUNICORN_THREADS threads.
+  A slow request ties up one thread, not a whole worker.
+- gevent: a process per CPU, each serving up to GUNICORN_WORKER_CONNECTIONS
+  requests at once on greenlets. Needs gevent, and psycogreen so that
+  database waits yield to other greenlets.
+- sync: gunicorn's default, one request per process; kept for comparison
+  (see benchmark.py).
+
+bcrypt runs in each worker's hashing pool (see hashing.py), so worker
+counts are kept close to the CPU count rather than gunicorn's usual
+2 x CPUs + 1 for sync workers. WEB_CONCURRENCY overrides the count.
+
+The app is loaded once in the master (`preload_app`) and workers fork from
+it; `post_fork` makes sure no worker reuses database connections it
+inherited. Workers are replaced after GUNICORN_MAX_REQUESTS requests (give
+or take GUNICORN_MAX_REQUESTS_JITTER, so they don't all restart at once),
+which bounds any slow growth in a worker's memory.
+"""
+
+import multiprocessing
+import os
+
+cpus = multiprocessing.cpu_count()
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Patch before the master preloads the app, so that the locks and
+    # threads the app makes at import are gevent's
+    from gevent import monkey
+    monkey.patch_all()
+
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        # Without it every query blocks the worker's other greenlets
+        pass
+    else:
+        patch_psycopg()
+
+if worker_class == 'sync':
+    default_workers = cpus * 2 + 1
+else:
+    default_workers = cpus
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Requests past the database pool's size (5 + 10 overflow per worker) wait
+# for a connection, so there's little to gain from many more greenlets
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 50))
+
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+preload_app = True
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    """Drop the database connections this worker inherited from the master.
+
+    A connection shared by two processes gets their queries interleaved on
+    one socket. close=False leaves the master's copies open for the master;
+    the worker just forgets them and connects afresh.
+    """
+
+    from models import db
+
+    flask_app = server.app.wsgi()
+    with flask_app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    """Write any likes still buffered in this worker (see likebuffer.py)."""
+
+    from likebuffer import flush_all
+
+    flush_all()
@@ -0,0 +1,135 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow (hundreds of milliseconds at the default work
+factor), so hashes and checks run in a small process pool. The number of
+hashes waiting on the pool is capped: past HASHING_POOL_MAX_PENDING, new
+requests fail fast with PoolSaturated (a 503 in app.py) instead of queueing
+up behind each other.
+
+Each app has a pool of its own, kept in app.extensions by `init_app`;
+`password_hasher` stands for the current app's.
+
+Configuration (read by `init_app`):
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes. Hashes made with a
+  different work factor are flagged by `needs_rehash`.
+- HASHING_POOL_WORKERS: pool size; 0 hashes on the calling thread.
+- HASHING_POOL_MAX_PENDING: hashes allowed in flight at once.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """Raised when too many hashes are already waiting on the pool."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+class HashingPool:
+    """Bounded process pool for bcrypt hashes and checks."""
+
+    def __init__(self, workers=2, max_pending=16, rounds=12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.setdefault(
+            'HASHING_POOL_WORKERS', self.workers)
+        self.max_pending = app.config.setdefault(
+            'HASHING_POOL_MAX_PENDING', self.max_pending)
+        app.extensions['password_hasher'] = self
+
+    def _get_executor(self):
+        # Pools don't survive a fork, so each worker process makes its own.
+        if self._executor_pid != os.getpid():
+            context = multiprocessing.get_context(
+                'forkserver'
+                if 'forkserver' in multiprocessing.get_all_start_methods()
+                else None)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                logger.warning("Hashing pool saturated (%d pending)",
+                               self.pending)
+                raise PoolSaturated()
+            self.pending += 1
+            self.submitted += 1
+            executor = self._get_executor()
+
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured work factor."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match bcrypt hash `pw_hash`?"""
+
+        return self._run(_check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+        return int(pw_hash.split('$')[2]) != self.rounds
+
+    def stats(self):
+        """Queue depth and throughput counters for this process."""
+
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+password_hasher = LocalProxy(
+    lambda: current_app.extensions['password_hasher'])
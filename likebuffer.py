@@ -0,0 +1,156 @@
+"""Write-behind buffer for likes and unlikes.
+
+Clicking a star used to be a transaction of its own, so a popular message
+meant a queue of one-row transactions. Clicks are now recorded in memory
+and applied in batches (see Like.apply_batch): one INSERT ... ON CONFLICT DO
+NOTHING for the likes, one DELETE for the unlikes and a recount of the
+affected users' counters. If a user likes and then unlikes a message before
+a flush, only the last click is written.
+
+A background thread flushes every LIKE_BUFFER_FLUSH_INTERVAL seconds, or
+sooner once LIKE_BUFFER_MAX_PENDING clicks are waiting. Whatever is still
+buffered is flushed when the process exits normally, which includes a
+gunicorn worker's graceful shutdown; a crash loses at most one interval's
+clicks. With an interval of 0 every click is written before the request
+returns.
+
+The buffer is per process, so the pages a user sees are kept consistent
+with their own clicks by the session overlay in app.py (`pending_likes`),
+which travels with them whichever worker serves the next request. Each app
+has a buffer of its own, kept in app.extensions by `init_app`;
+`like_buffer` stands for the current app's.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import weakref
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from models import db, Like
+
+logger = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    """Pending like/unlike clicks, {(user_id, message_id): liked}."""
+
+    def __init__(self, flush_interval=1.0, max_pending=500):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.app = None
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+
+        self.recorded = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config.setdefault(
+            'LIKE_BUFFER_FLUSH_INTERVAL', self.flush_interval)
+        self.max_pending = app.config.setdefault(
+            'LIKE_BUFFER_MAX_PENDING', self.max_pending)
+
+        app.extensions['like_buffer'] = self
+        _buffers.add(self)
+
+    def record(self, user_id, message_id, liked):
+        """Buffer a click: `liked` is True for a like, False for an unlike."""
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+            self.recorded += 1
+            backlog = len(self._pending)
+
+        if not self.flush_interval:
+            self.flush()
+            return
+
+        self._ensure_thread()
+        if backlog >= self.max_pending:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+
+        threading.Thread(
+            target=self._run, name='like-buffer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every buffered click to the database.
+
+        If the write fails, the clicks go back in the buffer (behind any
+        newer clicks for the same message) to be retried on the next flush.
+        """
+
+        # Held for the whole write so that a flush at exit waits for one
+        # the background thread already has in progress
+        with self._flush_lock:
+            with self._lock:
+                changes, self._pending = self._pending, {}
+
+            if not changes:
+                return
+
+            with self.app.app_context():
+                try:
+                    Like.apply_batch(changes)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    with self._lock:
+                        self.failed_flushes += 1
+                        for key, liked in changes.items():
+                            self._pending.setdefault(key, liked)
+                    logger.exception(
+                        "Failed to flush %d like changes", len(changes))
+                    return
+
+            with self._lock:
+                self.flushed += len(changes)
+
+    def stats(self):
+        """Backlog and throughput counters for this process."""
+
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'recorded': self.recorded,
+                'flushed': self.flushed,
+                'failed_flushes': self.failed_flushes,
+                'flush_interval': self.flush_interval,
+            }
+
+
+# Every app's buffer in this process, for `flush_all`
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def flush_all():
+    """Write the clicks buffered for every app in this process."""
+
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+like_buffer = LocalProxy(lambda: current_app.extensions['like_buffer'])
@@ -0,0 +1,273 @@
+"""Versioned schema migrations for Warbler.
+
+Run pending migrations with:
+
+    flask --app app migrate
+
+Each migration is a function registered with `@migration(version, ...)`
+that receives the engine. Applied versions are recorded in the
+schema_migrations table, so running `migrate` again is a no-op.
+
+Backfills run plain SQL on the engine rather than going through the models
+in models.py: those describe the latest schema, which a database part way
+through its upgrade doesn't have yet.
+
+Indexes are built with CREATE INDEX CONCURRENTLY on Postgres, which doesn't
+block writes to the table, so a live deployment can be migrated in place.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import db, SEARCH_CONFIG
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('description', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register the decorated function as migration number `version`."""
+
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return register
+
+
+def upgrade(engine, echo=print):
+    """Apply every migration that hasn't been applied yet, in order."""
+
+    schema_migrations.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        applied = set(conn.execute(db.select(schema_migrations.c.version))
+                      .scalars())
+
+    for version, description, fn in MIGRATIONS:
+        if version in applied:
+            continue
+
+        echo(f"Applying {version:04d} {description}")
+        fn(engine)
+
+        with engine.begin() as conn:
+            conn.execute(schema_migrations.insert().values(
+                version=version,
+                description=description,
+                applied_at=datetime.utcnow(),
+            ))
+
+
+##############################################################################
+# Helpers
+
+
+def add_column(engine, table, column, ddl):
+    """ALTER TABLE `table` ADD `column` `ddl`, unless it's already there."""
+
+    columns = {col['name'] for col in inspect(engine).get_columns(table)}
+    if column not in columns:
+        with engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def create_index(engine, name, definition):
+    """Build index `name` ON `definition` without locking out writes.
+
+    On Postgres this uses CREATE INDEX CONCURRENTLY, which can't run inside a
+    transaction and, if it fails, leaves an INVALID index behind; any such
+    leftover from an earlier attempt is dropped and rebuilt.
+    """
+
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS {name} ON {definition}'))
+        return
+
+    autocommit = engine.execution_options(isolation_level='AUTOCOMMIT')
+
+    with autocommit.connect() as conn:
+        is_invalid = conn.execute(text(
+            'SELECT 1 FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name AND NOT i.indisvalid'
+        ), {'name': name}).first()
+
+        if is_invalid:
+            conn.execute(text(f'DROP INDEX CONCURRENTLY {name}'))
+
+        conn.execute(text(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}'))
+
+
+def backfill_search_vectors(engine, batch_size=10000):
+    """Compute messages.search_vector wherever it's missing (Postgres only).
+
+    Walks the table in primary-key order, `batch_size` ids per batch and
+    each batch in its own transaction, so it never holds row locks on the
+    whole table and every batch starts from the index rather than rescanning
+    the rows (and dead row versions) that earlier batches went past.
+    """
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    last_id = 0
+
+    while True:
+        with engine.begin() as conn:
+            last_id = conn.execute(text(
+                'WITH batch AS ('
+                '  SELECT id FROM messages WHERE id > :last_id '
+                '  ORDER BY id LIMIT :batch_size'
+                '), updated AS ('
+                '  UPDATE messages '
+                '  SET search_vector = to_tsvector(:config, text) '
+                '  WHERE id IN (SELECT id FROM batch) '
+                '  AND search_vector IS NULL'
+                ') '
+                'SELECT max(id) FROM batch'
+            ), {
+                'config': SEARCH_CONFIG,
+                'last_id': last_id,
+                'batch_size': batch_size,
+            }).scalar()
+
+        if last_id is None:
+            break
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, "initial schema")
+def initial_schema(engine):
+    """Create any tables that don't exist yet.
+
+    On a new database this builds the whole current schema, which makes the
+    later migrations no-ops; on an older database it only adds new tables.
+    """
+
+    db.metadata.create_all(engine)
+
+
+@migration(2, "denormalized user counters")
+def user_counters(engine):
+    for column in ('messages_count', 'followers_count',
+                   'following_count', 'likes_count'):
+        add_column(engine, 'users', column, "INTEGER NOT NULL DEFAULT 0")
+
+    with engine.begin() as conn:
+        conn.execute(text(
+            'UPDATE users SET '
+            'messages_count = (SELECT count(*) FROM messages '
+            '  WHERE messages.user_id = users.id), '
+            'followers_count = (SELECT count(*) FROM follows '
+            '  WHERE follows.user_being_followed_id = users.id), '
+            'following_count = (SELECT count(*) FROM follows '
+            '  WHERE follows.user_following_id = users.id), '
+            'likes_count = (SELECT count(*) FROM likes '
+            '  WHERE likes.user_id = users.id)'
+        ))
+
+
+@migration(3, "backfill home timelines")
+def backfill_timelines(engine):
+    with engine.begin() as conn:
+        conn.execute(text('DELETE FROM timeline_entries'))
+        conn.execute(text(
+            'INSERT INTO timeline_entries '
+            '  (user_id, message_id, author_id, timestamp) '
+            'SELECT user_id, id, user_id, timestamp FROM messages '
+            'UNION ALL '
+            'SELECT follows.user_following_id, messages.id, '
+            '  messages.user_id, messages.timestamp '
+            'FROM messages JOIN follows '
+            '  ON follows.user_being_followed_id = messages.user_id '
+            'WHERE follows.user_following_id <> follows.user_being_followed_id'
+        ))
+
+
+@migration(4, "secondary indexes for feeds, follows and likes")
+def secondary_indexes(engine):
+    create_index(
+        engine,
+        'ix_messages_user_id_timestamp',
+        'messages (user_id, timestamp)',
+    )
+    create_index(
+        engine,
+        'ix_follows_user_following_id',
+        'follows (user_following_id)',
+    )
+    create_index(
+        engine,
+        'ix_likes_message_id',
+        'likes (message_id)',
+    )
+
+
+@migration(5, "trigram and prefix indexes for username search")
+def username_search_indexes(engine):
+    """See search.py; other backends search an in-process index instead."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+    create_index(
+        engine,
+        'ix_users_username_trgm',
+        'users USING gin (username gin_trgm_ops)',
+    )
+    create_index(
+        engine,
+        'ix_users_username_lower_pattern',
+        'users (lower(username) text_pattern_ops)',
+    )
+
+
+@migration(6, "full-text search documents for messages")
+def message_search_vectors(engine, batch_size=10000):
+    """Add and backfill messages.search_vector, then index it."""
+
+    if engine.dialect.name != 'postgresql':
+        add_column(engine, 'messages', 'search_vector', 'TEXT')
+        return
+
+    add_column(engine, 'messages', 'search_vector', 'TSVECTOR')
+    backfill_search_vectors(engine, batch_size)
+    create_index(
+        engine,
+        'ix_messages_search_vector',
+        'messages USING gin (search_vector)',
+    )
+
+
+@migration(7, "users.updated_at version stamp")
+def user_updated_at(engine):
+    if engine.dialect.name != 'postgresql':
+        # SQLite can't add a column with a non-constant default
+        add_column(
+            engine, 'users', 'updated_at',
+            "TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00'")
+        with engine.begin() as conn:
+            conn.execute(text('UPDATE users SET updated_at = CURRENT_TIMESTAMP'))
+        return
+
+    add_column(
+        engine, 'users', 'updated_at',
+        "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
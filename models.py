@@ -1,16 +1,87 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import Counter
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import (
+    joinedload, make_transient_to_detached, object_session)
+from sqlalchemy.orm.util import identity_key
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from cache import cache, invalidate_on_commit, flush_invalidations
+from routing import RoutingSession, on_primary
+
+from hashing import password_hasher
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+SEARCH_CONFIG = 'english'
+
+
+def insert_ignoring_conflicts(model):
+    """INSERT into `model`'s table that skips rows already there.
+
+    INSERT ... ON CONFLICT DO NOTHING, in the current database's dialect.
+    """
+
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
+
+
+def insert_returning(model, rows, column):
+    """INSERT `rows` into `model`'s table, skipping rows already there.
+
+    Returns `column` of each row actually inserted. SQLite has no
+    RETURNING here, so there the existing keys are read first, in the
+    same transaction.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.scalars(
+            insert_ignoring_conflicts(model)
+            .values(rows)
+            .returning(column)).all()
+
+    key_columns = list(model.__table__.primary_key.columns)
+    keys = [tuple(row[c.key] for c in key_columns) for row in rows]
+    existing = set(db.session.execute(
+        db.select(*key_columns)
+        .where(db.tuple_(*key_columns).in_(keys))).all())
+
+    db.session.execute(insert_ignoring_conflicts(model), rows)
+
+    values = []
+    for row, key in zip(rows, keys):
+        if key not in existing:
+            existing.add(key)
+            values.append(row[column.key])
+    return values
+
+
+def delete_returning(model, condition, column):
+    """DELETE `model`'s rows matching `condition`.
+
+    Returns `column` of each deleted row. SQLite has no RETURNING here,
+    so there the rows are read first, in the same transaction.
+    """
+
+    delete = (db.delete(model)
+              .where(condition)
+              .execution_options(synchronize_session=False))
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.scalars(delete.returning(column)).all()
+
+    values = db.session.scalars(db.select(column).where(condition)).all()
+    db.session.execute(delete)
+    return values
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -29,6 +100,41 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers lookups by the followed user; this index covers
+    # the reverse direction ("who does this user follow?").
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
+    @classmethod
+    def follow(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`, if they don't already.
+
+        One INSERT ... ON CONFLICT DO NOTHING; returns whether a follow was
+        added. Raises IntegrityError if either user doesn't exist.
+        """
+
+        result = db.session.execute(
+            insert_ignoring_conflicts(cls).values(
+                user_following_id=follower_id,
+                user_being_followed_id=followed_id,
+            ))
+        return result.rowcount == 1
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Make `follower_id` stop following `followed_id`, if they do.
+
+        One DELETE; returns whether a follow was removed.
+        """
+
+        result = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_following_id == follower_id)
+            .where(cls.user_being_followed_id == followed_id)
+            .execution_options(synchronize_session=False))
+        return result.rowcount == 1
+
 
 class User(db.Model):
     """User in the system."""
@@ -75,20 +181,78 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # Denormalized counters, kept up to date by the write paths in app.py
+    # (see `adjust_counts`) and repairable in bulk with `recount`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped on every UPDATE of the row, counters included, so it serves
+    # as a cheap version stamp for the user's pages (see ETags in app.py).
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # The collections below are dynamic: reading one runs a query (which can
+    # be filtered, ordered and paged like any other), and appending to or
+    # removing from one is a single INSERT or DELETE at flush, without
+    # loading the rest of the collection. Rows go away with the database's
+    # ON DELETE CASCADE, so deletes don't load them either.
+
+    messages = db.relationship(
+        'Message',
+        backref='user',
+        lazy='dynamic',
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        backref="following",
+        backref=db.backref(
+            'following', lazy='dynamic', passive_deletes=True),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     liked_messages = db.relationship(
         'Message',
         secondary='likes',
-        backref='likers'
+        backref=db.backref('likers', lazy='dynamic', passive_deletes=True),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -101,7 +265,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -123,30 +287,221 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with an old work factor, it's replaced
+        with a new hash (the caller commits it).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def card_select(cls):
+        """SELECT of just the columns a user card shows.
+
+        Rows from it have .id, .username, .image_url and .header_image_url,
+        so templates can use them in place of User objects.
+        """
+
+        return db.select(
+            cls.id,
+            cls.username,
+            cls.image_url,
+            cls.header_image_url,
+        )
+
+    @classmethod
+    def directory_page(cls, after=None, limit=24):
+        """Page of user cards in username order, after username `after`.
+
+        Keyset pagination on the unique username index keeps every page the
+        same cost. Returns (rows, has_more).
+        """
+
+        select = cls.card_select()
+        if after:
+            select = select.where(cls.username > after)
+
+        rows = db.session.execute(
+            select.order_by(cls.username).limit(limit + 1)).all()
+
+        return rows[:limit], len(rows) > limit
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add `deltas` to a user's counters in a single UPDATE.
+
+        For example: User.adjust_counts(user.id, messages_count=1)
+        """
+
+        (cls.query
+            .filter(cls.id == user_id)
+            .update(
+                {getattr(cls, name): getattr(cls, name) + delta
+                 for name, delta in deltas.items()},
+                synchronize_session=False,
+            ))
+
+        invalidate_on_commit(db.session, f'user:{user_id}')
+
+    @classmethod
+    def adjust_likes_counts(cls, deltas):
+        """Add `deltas` ({user_id: delta}) to users' likes_count in a
+        single UPDATE.
+        """
+
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        (cls.query
+            .filter(cls.id.in_(deltas))
+            .update(
+                {cls.likes_count: cls.likes_count
+                 + db.case(deltas, value=cls.id, else_=0)},
+                synchronize_session=False,
+            ))
+
+        invalidate_on_commit(
+            db.session, *(f'user:{user_id}' for user_id in deltas))
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute the counters from the underlying tables.
+
+        Recounts every user, or just those in `user_ids`.
+        """
+
+        def count_of(column, match):
+            return (db.select(db.func.count(column))
+                    .where(match == cls.id)
+                    .scalar_subquery())
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        query.update(
+            {
+                cls.messages_count: count_of(Message.id, Message.user_id),
+                cls.followers_count: count_of(
+                    Follows.user_following_id,
+                    Follows.user_being_followed_id),
+                cls.following_count: count_of(
+                    Follows.user_being_followed_id,
+                    Follows.user_following_id),
+                cls.likes_count: count_of(Like.message_id, Like.user_id),
+            },
+            synchronize_session=False,
+        )
+
+        if user_ids is None:
+            invalidate_on_commit(db.session, 'users')
+        else:
+            invalidate_on_commit(
+                db.session, *(f'user:{user_id}' for user_id in user_ids))
+
+    @classmethod
+    def get_cached(cls, user_id, ttl=None):
+        """The user with id `user_id` (or None), read through the cache.
+
+        Cached users are attached to the session without a query, as if
+        they'd just been loaded (or, if the session holds an expired copy,
+        refreshed); their password hash is never cached, and is loaded from
+        the database if it's used. Relationships load lazily as usual.
+        """
+
+        user = db.session.identity_map.get(identity_key(cls, user_id))
+        if user is not None and (db.session.is_modified(user)
+                                 or not db.inspect(user).expired_attributes):
+            return user
+
+        columns = cache.cached(
+            'user',
+            f'user:{user_id}',
+            lambda: cls._fetch_cache_row(user_id),
+            ttl=ttl,
+            tags=('users', f'user:{user_id}'),
+        )
+        if columns is None:
+            return None
+
+        user = cls(**columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @classmethod
+    def _fetch_cache_row(cls, user_id):
+        columns = [column for column in cls.__table__.columns
+                   if column.key != 'password']
+        with on_primary():
+            row = db.session.execute(
+                db.select(*columns).where(cls.id == user_id)
+            ).mappings().first()
+        return dict(row) if row else None
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Returns a set of ids, fetched with one id-only query on likes.
+        """
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == self.id)
+            .where(Like.message_id.in_(message_ids))
+        ))
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set of ids, fetched with one indexed query on follows.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id.in_(user_ids))
+        ))
+
+    def follower_ids(self, user_ids):
+        """Which of `user_ids` are following this user?
+
+        Returns a set of ids, fetched with one indexed query on follows.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id)
+            .where(Follows.user_following_id.in_(user_ids))
+        ))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids([other_user.id])
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
 
 
 class Message(db.Model):
@@ -176,8 +531,357 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Full-text search document for `text` (Postgres only; see search.py).
+    # Deferred so ordinary message queries don't load it.
+    search_vector = db.deferred(db.Column(
+        TSVECTOR().with_variant(db.Text, 'sqlite'),
+    ))
+
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def is_liked_by(self, user):
-        return user in self.likers
+        """Has `user` liked this message?"""
+
+        return self.id in user.liked_message_ids([self.id])
+
+    def index_for_search(self):
+        """Compute this message's search document as part of its INSERT or
+        UPDATE. A no-op on backends without full-text search."""
+
+        if db.engine.dialect.name == 'postgresql':
+            self.search_vector = db.func.to_tsvector(SEARCH_CONFIG, self.text)
+
+    @classmethod
+    def feed_select(cls):
+        """SELECT of just the columns the JSON API shows for a message.
+
+        Rows from it have .id, .text, .timestamp and the author's .user_id,
+        .username and .image_url.
+        """
+
+        return db.select(
+            cls.id,
+            cls.text,
+            cls.timestamp,
+            User.id.label('user_id'),
+            User.username,
+            User.image_url,
+        ).join(User, User.id == cls.user_id)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Messages are fanned out to their author and the author's followers when
+    they are written, so reading a home timeline is a single range scan over
+    (user_id, timestamp) instead of an IN (...) over everyone followed.
+    Entries for deleted messages and users go away with the ON DELETE CASCADE.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            'user_id',
+            'timestamp',
+            'message_id',
+        ),
+    )
+
+    def __repr__(self):
+        return (f'<TimelineEntry user_id={self.user_id} '
+                f'message_id={self.message_id}>')
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to the timelines of its author and their followers.
+
+        The message must already be flushed so that it has an id. A follow
+        of the author by themselves (which the follow view refuses, but
+        older data may hold) doesn't add their entry twice.
+        """
+
+        author = db.select(
+            db.literal(message.user_id),
+            db.literal(message.id),
+            db.literal(message.user_id),
+            db.literal(message.timestamp),
+        )
+        followers = db.select(
+            Follows.user_following_id,
+            db.literal(message.id),
+            db.literal(message.user_id),
+            db.literal(message.timestamp),
+        ).where(
+            Follows.user_being_followed_id == message.user_id,
+            Follows.user_following_id != message.user_id,
+        )
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.union_all(author, followers),
+            )
+        )
+
+        cls.invalidate_author(message.user_id)
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, limit=100):
+        """Copy `followed_id`'s newest `limit` messages into `user_id`'s
+        timeline.
+
+        Following someone with years of history shouldn't copy all of it
+        on the request; a page's worth covers what the timeline shows
+        first, and their older messages stay on their profile.
+        """
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.select(
+                    db.literal(user_id),
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp,
+                )
+                .where(Message.user_id == followed_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit),
+            )
+        )
+
+        invalidate_on_commit(db.session, f'timeline:{user_id}')
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove `followed_id`'s messages from `user_id`'s timeline."""
+
+        (cls.query
+            .filter(cls.user_id == user_id, cls.author_id == followed_id)
+            .delete(synchronize_session=False))
+
+        invalidate_on_commit(db.session, f'timeline:{user_id}')
+
+    @classmethod
+    def rebuild(cls, user_ids=None, limit=100):
+        """Recompute timelines from the messages and follows tables.
+
+        Rebuilds every timeline, or just those of `user_ids`. As when
+        following someone (see `backfill`), each followed user contributes
+        their newest `limit` messages; the user's own are all included.
+
+        Used after bulk loads (see bulkload.py) that bypass the write paths,
+        which rebuild a chunk of users at a time.
+        """
+
+        query = cls.query
+        own = db.select(
+            Message.user_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        )
+        follows = Follows.user_following_id != Follows.user_being_followed_id
+
+        if user_ids is not None:
+            query = query.filter(cls.user_id.in_(user_ids))
+            own = own.where(Message.user_id.in_(user_ids))
+            follows = db.and_(
+                follows, Follows.user_following_id.in_(user_ids))
+
+        query.delete(synchronize_session=False)
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.union_all(own, cls._newest_followed(follows, limit)),
+            )
+        )
+
+        if user_ids is None:
+            invalidate_on_commit(db.session, 'timelines')
+        else:
+            invalidate_on_commit(
+                db.session, *(f'timeline:{user_id}' for user_id in user_ids))
+
+    @staticmethod
+    def _newest_followed(follows, limit):
+        """SELECT of (follower, message id, author, timestamp) for the newest
+        `limit` messages of each followed user, over the follows matching
+        `follows`.
+
+        On Postgres each follow reads just its newest messages off the
+        (user_id, timestamp) index with a LATERAL subquery; elsewhere the
+        followed users' messages are ranked with a window function.
+        """
+
+        newest_first = (Message.timestamp.desc(), Message.id.desc())
+
+        if db.engine.dialect.name == 'postgresql':
+            newest = (db.select(Message.id, Message.user_id, Message.timestamp)
+                      .where(Message.user_id == Follows.user_being_followed_id)
+                      .order_by(*newest_first)
+                      .limit(limit)
+                      .lateral())
+
+            return (db.select(
+                        Follows.user_following_id,
+                        newest.c.id,
+                        newest.c.user_id,
+                        newest.c.timestamp)
+                    .select_from(Follows)
+                    .join(newest, db.true())
+                    .where(follows))
+
+        ranked = (db.select(
+                      Message.id,
+                      Message.user_id,
+                      Message.timestamp,
+                      db.func.row_number().over(
+                          partition_by=Message.user_id,
+                          order_by=newest_first,
+                      ).label('rank'))
+                  .where(Message.user_id.in_(
+                      db.select(Follows.user_being_followed_id).where(follows)))
+                  .subquery())
+
+        return (db.select(
+                    Follows.user_following_id,
+                    ranked.c.id,
+                    ranked.c.user_id,
+                    ranked.c.timestamp)
+                .join(ranked, ranked.c.user_id == Follows.user_being_followed_id)
+                .where(follows, ranked.c.rank <= limit))
+
+    @classmethod
+    def invalidate_author(cls, author_id, connection=None):
+        """Invalidate the cached timelines that show `author_id`'s messages.
+
+        That's the author's own and their followers', found with one query
+        on `connection` (or the session's).
+        """
+
+        follower_ids = (connection or db.session).execute(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == author_id)
+        ).scalars()
+
+        invalidate_on_commit(
+            db.session,
+            f'timeline:{author_id}',
+            *(f'timeline:{user_id}' for user_id in follower_ids),
+        )
+
+    @classmethod
+    def version(cls, user_id):
+        """Cheap stamp that changes whenever `user_id`'s timeline does.
+
+        Every write to a timeline (fan-out, backfill, prune, deletes, and
+        profile edits by the authors on it) invalidates its cache tags, so
+        the tags' versions are the stamp, read in one cache round trip. The
+        newest message id on the timeline, a single step down its primary
+        key and cached under the same tags, covers a cache that has lost
+        the tags' counters.
+        """
+
+        tags = ('timelines', f'timeline:{user_id}')
+
+        def fetch():
+            with on_primary():
+                return db.session.scalar(
+                    db.select(db.func.max(cls.message_id))
+                    .where(cls.user_id == user_id))
+
+        newest = cache.cached(
+            'timeline_version', f'timeline-version:{user_id}', fetch, tags=tags)
+
+        return (newest, *cache.tag_versions(*tags))
+
+    @classmethod
+    def messages_for(cls, user_id, limit=100, before=None):
+        """Page of messages in `user_id`'s home timeline, newest first.
+
+        `before` is the (timestamp, message_id) of the last message already
+        shown; the index on (user_id, timestamp, message_id) makes every page
+        the same cost no matter how deep it is.
+
+        The ids on each page are cached until the timeline is next written;
+        on a hit the messages themselves are fetched by primary key. Either
+        way their authors come in the same query.
+
+        Returns (messages, has_more).
+        """
+
+        fetched = []
+
+        def fetch():
+            query = (Message
+                     .query
+                     .join(cls, cls.message_id == Message.id)
+                     .filter(cls.user_id == user_id)
+                     .options(joinedload(Message.user)))
+
+            if before:
+                query = query.filter(
+                    db.tuple_(cls.timestamp, cls.message_id)
+                    < db.tuple_(*before))
+
+            with on_primary():
+                fetched.extend(query
+                               .order_by(cls.timestamp.desc(),
+                                         cls.message_id.desc())
+                               .limit(limit + 1)
+                               .all())
+
+            return [message.id for message in fetched]
+
+        ids = cache.cached(
+            'timeline_page',
+            f'timeline-page:{user_id}:{limit}:{before}',
+            fetch,
+            tags=('timelines', f'timeline:{user_id}'),
+        )
+
+        if fetched:
+            messages = fetched
+        elif ids:
+            by_id = {message.id: message for message in
+                     Message.query
+                     .filter(Message.id.in_(ids))
+                     .options(joinedload(Message.user))}
+            # Messages deleted since the ids were cached are skipped
+            messages = [by_id[id] for id in ids if id in by_id]
+        else:
+            messages = []
+
+        return messages[:limit], len(ids) > limit
 
 
 class Like(db.Model):
@@ -196,16 +900,111 @@ class Like(db.Model):
         primary_key = True
     )
 
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     def __repr__(self):
         return f'<Like user_id={self.user_id} message_id={self.message_id}>'
 
+    @classmethod
+    def apply_batch(cls, changes):
+        """Apply a batch of likes and unlikes, then adjust their users'
+        likes_count by the rows actually inserted and deleted.
+
+        `changes` is {(user_id, message_id): liked}. Likes already there
+        and unlikes of likes that aren't are no-ops, as are changes for
+        users or messages deleted since.
+        """
+
+        user_ids = {user_id for user_id, _ in changes}
+        message_ids = {message_id for _, message_id in changes}
+
+        live_users = set(db.session.scalars(
+            db.select(User.id).where(User.id.in_(user_ids))))
+        live_messages = set(db.session.scalars(
+            db.select(Message.id).where(Message.id.in_(message_ids))))
+
+        likes = [
+            {'user_id': user_id, 'message_id': message_id}
+            for (user_id, message_id), liked in changes.items()
+            if liked and user_id in live_users
+            and message_id in live_messages
+        ]
+        unlikes = [key for key, liked in changes.items() if not liked]
+
+        deltas = Counter()
+
+        if likes:
+            deltas.update(insert_returning(cls, likes, cls.user_id))
+
+        if unlikes:
+            deltas.subtract(delete_returning(
+                cls,
+                db.tuple_(cls.user_id, cls.message_id).in_(unlikes),
+                cls.user_id))
+
+        User.adjust_likes_counts(deltas)
+
+
+##############################################################################
+# Cache invalidation (see cache.py)
+#
+# Row-level writes queue the tags they affect on the session, and the tags
+# are invalidated when the transaction ends. Bulk deletes can't say which
+# rows they hit, so they invalidate whole families of entries.
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    session = object_session(target)
+
+    # Fired for collection changes (like appending to user.messages) too
+    if not session.is_modified(target, include_collections=False):
+        return
+
+    invalidate_on_commit(session, f'user:{target.id}')
+
+    # Timelines show their authors' names and pictures
+    TimelineEntry.invalidate_author(target.id, connection)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    # Clears any cached miss for the id
+    invalidate_on_commit(object_session(target), f'user:{target.id}')
+
+
+@event.listens_for(User, 'before_delete')
+@event.listens_for(Message, 'before_delete')
+def _author_or_message_deleted(mapper, connection, target):
+    author_id = target.id if isinstance(target, User) else target.user_id
+
+    invalidate_on_commit(object_session(target), f'user:{author_id}')
+    TimelineEntry.invalidate_author(author_id, connection)
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def _bulk_deleted(delete_context):
+    if delete_context.mapper.class_ in (User, Message, TimelineEntry):
+        invalidate_on_commit(delete_context.session, 'users', 'timelines')
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _transaction_ended(session):
+    flush_invalidations(session)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    For scripts and tests that use the models at module level: pushes an
+    app context for the rest of the process. Apps made by create_app are
+    already connected, and the web server never calls this.
     """
 
     app.app_context().push()
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    if 'sqlalchemy' not in app.extensions:
+        db.init_app(app)
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""Opaque cursors for keyset pagination."""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor from a query string can't be decoded."""
+
+
+def _pack(values):
+    payload = json.dumps(values, separators=(',', ':'))
+    return urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _unpack(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(urlsafe_b64decode(padded))
+
+
+def encode_cursor(timestamp, row_id):
+    """Pack a (timestamp, id) sort key into a URL-safe token."""
+
+    return _pack([timestamp.isoformat(), row_id])
+
+
+def decode_cursor(cursor):
+    """Unpack a token made by `encode_cursor` into (timestamp, id)."""
+
+    try:
+        timestamp, row_id = _unpack(cursor)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (BinasciiError, TypeError, ValueError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def encode_score_cursor(score, row_id):
+    """Pack a (score, id) sort key, e.g. a search ranking, into a token."""
+
+    return _pack([score, row_id])
+
+
+def decode_score_cursor(cursor):
+    """Unpack a token made by `encode_score_cursor` into (score, id)."""
+
+    try:
+        score, row_id = _unpack(cursor)
+        return float(score), int(row_id)
+    except (BinasciiError, TypeError, ValueError) as exc:
+        raise InvalidCursor(cursor) from exc
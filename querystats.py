@@ -0,0 +1,160 @@
+"""Per-request SQL statement counting and N+1 detection.
+
+Every statement run through SQLAlchemy is timed and fingerprinted (literals
+stripped) into the current request's QueryStats. After the request we log
+the totals per endpoint, warn when the same fingerprint repeats often enough
+to look like an N+1 loop, and, in debug mode, send the numbers back in
+X-Query-* response headers.
+
+Tests can bound the number of queries a block of code makes with:
+
+    with assert_max_queries(5):
+        client.get('/')
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+N_PLUS_ONE_THRESHOLD = 5
+
+_local = threading.local()
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN \((?:\s*\?\s*,?)+\)|\bIN \(\[POSTCOMPILE_\w+\]\)",
+                       re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """Normalize `statement` so queries differing only in values match."""
+
+    statement = _LITERALS.sub('?', statement)
+    statement = _IN_LISTS.sub('IN (...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryStats:
+    """Statement count, total time and fingerprints for one unit of work."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold=2):
+        """Fingerprints that ran at least `threshold` times, most first."""
+
+        return [(stmt, n) for stmt, n in self.fingerprints.most_common()
+                if n >= threshold]
+
+    def report(self):
+        """Human-readable summary, for logs and assertion messages."""
+
+        lines = [f"{self.count} queries in {self.duration * 1000:.1f}ms"]
+        lines += [f"  {n}x {stmt}" for stmt, n in self.repeated()]
+        return "\n".join(lines)
+
+
+def _active_stats():
+    """Every QueryStats the current statement should be recorded in."""
+
+    active = list(getattr(_local, 'collectors', ()))
+    if has_app_context() and 'query_stats' in g:
+        active.append(g.query_stats)
+    return active
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+
+    for stats in _active_stats():
+        stats.record(statement, duration)
+
+
+@contextmanager
+def count_queries():
+    """Collect QueryStats for every statement run inside the block."""
+
+    stats = QueryStats()
+    collectors = _local.__dict__.setdefault('collectors', [])
+    collectors.append(stats)
+
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail with a summary of the queries if the block runs more than
+    `limit` statements."""
+
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count > limit:
+        raise AssertionError(
+            f"Expected at most {limit} queries, got {stats.report()}")
+
+
+def _log_stats(endpoint, stats):
+    logger.info("%s: %s", endpoint, stats.report())
+
+    suspects = stats.repeated(N_PLUS_ONE_THRESHOLD)
+    if suspects:
+        logger.warning(
+            "Possible N+1 in %s: %s", endpoint,
+            "; ".join(f"{n}x {stmt}" for stmt, n in suspects))
+
+
+def init_app(app):
+    """Start collecting QueryStats for every request to `app`."""
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        endpoint = f"{request.method} {request.endpoint}"
+
+        if response.is_streamed:
+            # Streamed templates keep querying while the body is sent, so
+            # headers can't carry the totals; log them once it's done.
+            response.call_on_close(lambda: _log_stats(endpoint, stats))
+            return response
+
+        _log_stats(endpoint, stats)
+
+        if app.debug or app.config.get('QUERY_STATS_HEADERS'):
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time-Ms'] = f"{stats.duration * 1000:.1f}"
+            response.headers['X-Query-Repeated'] = str(len(stats.repeated()))
+
+        return response
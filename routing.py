@@ -0,0 +1,104 @@
+"""Read-replica routing for db.session.
+
+Replicas are Flask-SQLAlchemy binds named replica0, replica1, ... (see
+SQLALCHEMY_BINDS; config.py fills them in from DATABASE_REPLICA_URLS). Reads
+made while handling a GET or HEAD request go to a randomly chosen replica;
+everything else goes to the primary:
+
+- writes (flushes, INSERT/UPDATE/DELETE statements), and any read after a
+  write in the same request
+- every query of a request with another method
+- work outside a request (CLI commands, background threads)
+- reads inside `on_primary()`
+
+Replicas lag the primary, so a user who has just written is pinned to the
+primary for READ_YOUR_WRITES_SECONDS: the deadline is kept in their
+session, so it holds whichever worker serves them next.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND_PREFIX = 'replica'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    """Session that sends reads to replicas when it's safe to."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+
+        writing = self._flushing or getattr(clause, 'is_dml', False)
+
+        if has_request_context():
+            if writing:
+                g.wrote_to_primary = True
+                g.read_from_replica = False
+
+            elif g.get('read_from_replica'):
+                replicas = [
+                    engine for key, engine in self._db.engines.items()
+                    if key and key.startswith(REPLICA_BIND_PREFIX)
+                ]
+                if replicas:
+                    return random.choice(replicas)
+
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+def pin_to_primary():
+    """Send this user's reads to the primary for the next few seconds."""
+
+    g.wrote_to_primary = True
+    g.read_from_replica = False
+
+
+@contextmanager
+def on_primary():
+    """Read from the primary inside the block.
+
+    For reads whose results outlive the request (like cache fills), which
+    mustn't pick up a lagging replica's stale rows.
+    """
+
+    if not has_request_context():
+        yield
+        return
+
+    was_reading_replica = g.get('read_from_replica')
+    g.read_from_replica = False
+    try:
+        yield
+    finally:
+        # A write inside the block keeps the rest of the request on the
+        # primary
+        if not g.get('wrote_to_primary'):
+            g.read_from_replica = was_reading_replica
+
+
+def init_app(app):
+    """Decide where each request reads from, and pin users who write."""
+
+    app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+
+    @app.before_request
+    def choose_read_database():
+        g.wrote_to_primary = False
+        g.read_from_replica = (
+            request.method in READ_METHODS
+            and time.time() >= session.get('primary_until', 0)
+        )
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        if g.get('wrote_to_primary'):
+            session['primary_until'] = (
+                time.time() + app.config['READ_YOUR_WRITES_SECONDS'])
+        return response
@@ -0,0 +1,243 @@
+"""Username search for /users and full-text search for /messages/search.
+
+Users
+-----
+
+On Postgres, substring matches use a pg_trgm GIN index (see migration 5) and
+are ranked by trigram similarity. Queries shorter than a trigram can't use
+that index, so they are answered as prefix matches from a
+lower(username) text_pattern_ops index instead.
+
+Other backends (e.g. SQLite in development) fall back to an in-process
+trigram index over (id, username) that is built on first use and thrown
+away whenever users are written in this process.
+
+Messages
+--------
+
+On Postgres, messages carry a tsvector `search_vector` (filled in by
+`Message.index_for_search` when they're written, with a GIN index from
+migration 6). Results are ordered by a score that adds relevance to recency,
+and paged with a keyset cursor on (score, id).
+
+Other backends match every search term with ILIKE and order by recency.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Message, SEARCH_CONFIG
+from pagination import (encode_cursor, decode_cursor,
+                        encode_score_cursor, decode_score_cursor)
+
+TRIGRAM_LENGTH = 3
+
+# A message this many days newer outranks any difference in relevance
+SEARCH_RECENCY_DAYS = 30
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in `text` (using backslash as the escape)."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def trigrams(text):
+    """Trigrams of `text`, padded the way pg_trgm pads words."""
+
+    padded = f"  {text.lower()} "
+    return {padded[i:i + TRIGRAM_LENGTH]
+            for i in range(len(padded) - TRIGRAM_LENGTH + 1)}
+
+
+def similarity(a, b):
+    """pg_trgm-style similarity between two strings (0 to 1)."""
+
+    a, b = trigrams(a), trigrams(b)
+    return len(a & b) / len(a | b) if a or b else 0
+
+
+def search_users(query, page=1, per_page=20):
+    """Page `page` of users whose username contains `query`, best first.
+
+    Returns (users, has_more); users are `User.card_select()` rows.
+    """
+
+    query = query.lower()
+    offset = (page - 1) * per_page
+
+    if db.engine.dialect.name == 'postgresql':
+        user_ids = _search_postgres(query, offset, per_page + 1)
+    else:
+        user_ids = username_index.search(query, offset, per_page + 1)
+
+    has_more = len(user_ids) > per_page
+    user_ids = user_ids[:per_page]
+
+    users = {user.id: user for user in db.session.execute(
+        User.card_select().where(User.id.in_(user_ids)))}
+    return [users[id] for id in user_ids if id in users], has_more
+
+
+def _search_postgres(query, offset, limit):
+    """Ranked user ids from the pg_trgm / text_pattern_ops indexes."""
+
+    if len(query) < TRIGRAM_LENGTH:
+        lowered = db.func.lower(User.username)
+        select = (db.select(User.id)
+                  .where(lowered.like(f"{escape_like(query)}%", escape='\\'))
+                  .order_by(lowered))
+    else:
+        select = (db.select(User.id)
+                  .where(User.username.ilike(
+                      f"%{escape_like(query)}%", escape='\\'))
+                  .order_by(db.func.similarity(User.username, query).desc(),
+                            User.username))
+
+    return list(db.session.scalars(select.offset(offset).limit(limit)))
+
+
+class UsernameIndex:
+    """In-process trigram index of usernames, for non-Postgres backends."""
+
+    def __init__(self):
+        self.names = None
+        self.postings = None
+
+    def invalidate(self):
+        self.names = None
+        self.postings = None
+
+    def build(self):
+        self.names = {}
+        self.postings = {}
+
+        for user_id, username in db.session.execute(
+                db.select(User.id, User.username)):
+            self.names[user_id] = username.lower()
+            for gram in trigrams(username):
+                self.postings.setdefault(gram, set()).add(user_id)
+
+    def search(self, query, offset, limit):
+        if self.names is None:
+            self.build()
+
+        if len(query) < TRIGRAM_LENGTH:
+            matches = sorted(
+                (name, id) for id, name in self.names.items()
+                if name.startswith(query))
+            return [id for name, id in matches[offset:offset + limit]]
+
+        # Every trigram inside the query (ignoring the word-boundary padding)
+        # must appear in a matching username.
+        inner = {query[i:i + TRIGRAM_LENGTH]
+                 for i in range(len(query) - TRIGRAM_LENGTH + 1)}
+        postings = sorted((self.postings.get(gram, set()) for gram in inner),
+                          key=len)
+        candidates = set.intersection(*postings)
+
+        matches = sorted(
+            (-similarity(self.names[id], query), self.names[id], id)
+            for id in candidates
+            if query in self.names[id])
+        return [id for _, _, id in matches[offset:offset + limit]]
+
+
+username_index = UsernameIndex()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def _user_added_or_removed(mapper, connection, target):
+    username_index.invalidate()
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    if db.inspect(target).attrs.username.history.has_changes():
+        username_index.invalidate()
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def _users_bulk_deleted(delete_context):
+    if delete_context.mapper.class_ is User:
+        username_index.invalidate()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _rolled_back(session, previous_transaction):
+    username_index.invalidate()
+
+
+def search_messages(query, cursor=None, per_page=20):
+    """Page of messages matching `query`, best first.
+
+    `cursor` is the next_cursor returned with the previous page (raises
+    pagination.InvalidCursor if it's malformed).
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        search = _search_messages_postgres
+    else:
+        search = _search_messages_fallback
+
+    return search(query, cursor, per_page)
+
+
+def _search_messages_postgres(query, cursor, per_page):
+    tsquery = db.func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    relevance = db.func.ts_rank_cd(Message.search_vector, tsquery, 32)
+    recency = (db.func.extract('epoch', Message.timestamp)
+               / (SEARCH_RECENCY_DAYS * 24 * 60 * 60))
+    score = db.cast(relevance, db.Float) + recency
+
+    select = (db.select(Message, score)
+              .where(Message.search_vector.op('@@')(tsquery))
+              .options(joinedload(Message.user)))
+
+    if cursor:
+        select = select.where(
+            db.tuple_(score, Message.id) < db.tuple_(
+                *decode_score_cursor(cursor)))
+
+    rows = db.session.execute(
+        select.order_by(score.desc(), Message.id.desc()).limit(per_page + 1)
+    ).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        last_message, last_score = rows[per_page - 1]
+        next_cursor = encode_score_cursor(last_score, last_message.id)
+
+    return [message for message, _ in rows[:per_page]], next_cursor
+
+
+def _search_messages_fallback(query, cursor, per_page):
+    select = db.select(Message).options(joinedload(Message.user))
+
+    for term in query.split():
+        select = select.where(
+            Message.text.ilike(f"%{escape_like(term)}%", escape='\\'))
+
+    if cursor:
+        select = select.where(
+            db.tuple_(Message.timestamp, Message.id) < db.tuple_(
+                *decode_cursor(cursor)))
+
+    messages = db.session.scalars(
+        select
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(per_page + 1)
+    ).all()
+
+    next_cursor = None
+    if len(messages) > per_page:
+        last = messages[per_page - 1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return messages[:per_page], next_cursor
@@ -1,19 +1,17 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import app
+from bulkload import load_csvs
+from migrations import upgrade
+from models import db, connect_db
 
-db.drop_all()
-db.create_all()
-
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+connect_db(app)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+db.drop_all()
+upgrade(db.engine)
 
-db.session.commit()
+load_csvs({
+    'users': 'generator/users.csv',
+    'messages': 'generator/messages.csv',
+    'follows': 'generator/follows.csv',
+})
@@ -6,9 +6,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows, connect_db, Like
+from models import db, User, Message, Follows, connect_db, Like, TimelineEntry
+from querystats import count_queries
 
 from sqlalchemy.exc import IntegrityError
 
@@ -18,6 +20,7 @@ from sqlalchemy.exc import IntegrityError
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 # Now we can import app
 
@@ -90,7 +93,7 @@ class MessageModelTestCase(TestCase):
 
         #testing user to message relationship
         self.assertEqual(new_message_db.user, u1)
-        self.assertEqual(len(new_message_db.likers), 0)
+        self.assertEqual(new_message_db.likers.count(), 0)
 
 
     def test_new_invalid_message(self):
@@ -165,11 +168,88 @@ class MessageModelTestCase(TestCase):
         self.assertFalse(m1.is_liked_by(u2))
 
 
+    def test_timeline_loads_authors(self):
+        """ Test a timeline page brings its messages' authors along """
+
+        db.session.add(Follows(
+            user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.flush()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        # One query either way: a cache miss fetches the page, a hit fetches
+        # its cached ids by key
+        for attempt in ('miss', 'hit'):
+            with self.subTest(attempt=attempt):
+                db.session.expunge_all()
+
+                with count_queries() as stats:
+                    messages, _ = TimelineEntry.messages_for(self.u1_id)
+                    authors = {msg.user.username for msg in messages}
+
+                self.assertEqual(authors, {'u1', 'u2'})
+                self.assertEqual(stats.count, 1)
+
+    def test_timeline_backfill_newest(self):
+        """ Test following backfills only the followed user's newest messages """
+
+        for day in range(1, 4):
+            db.session.add(Message(
+                text=f"day-{day}",
+                user_id=self.u2_id,
+                timestamp=datetime(2022, 1, day)))
+        db.session.flush()
+
+        TimelineEntry.backfill(self.u1_id, self.u2_id, limit=2)
+        db.session.commit()
+
+        messages, _ = TimelineEntry.messages_for(self.u1_id)
+        self.assertEqual(
+            [msg.text for msg in messages], ['This is also text', 'day-3'])
+
+    def test_timeline_version(self):
+        """ Test the timeline stamp is free to re-read and changes with
+        followed users' posts, profile edits and unfollows """
+
+        Follows.follow(self.u1_id, self.u2_id)
+        TimelineEntry.backfill(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        version = TimelineEntry.version(self.u1_id)
+
+        with count_queries() as stats:
+            self.assertEqual(TimelineEntry.version(self.u1_id), version)
+        self.assertEqual(stats.count, 0)
+
+        def changes(write):
+            nonlocal version
+            write()
+            db.session.commit()
+            old, version = version, TimelineEntry.version(self.u1_id)
+            return version != old
+
+        def post():
+            msg = Message(text="new", user_id=self.u2_id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+
+        def edit_profile():
+            User.query.get(self.u2_id).image_url = '/new-avatar.png'
+
+        def unfollow():
+            Follows.unfollow(self.u1_id, self.u2_id)
+            TimelineEntry.prune(self.u1_id, self.u2_id)
+
+        self.assertTrue(changes(post))
+        self.assertTrue(changes(edit_profile))
+        self.assertTrue(changes(unfollow))
+
     def test_delete_user_deletes_messages(self):
         """ Test that deleting a user deletes their messages """
 
         u1 = User.query.get(self.u1_id)
-        u1_num_messages = len(u1.messages)
+        u1_num_messages = u1.messages.count()
         num_messages_before = len(Message.query.all())
 
         User.query.filter(User.id == u1.id).delete()
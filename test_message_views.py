@@ -6,9 +6,15 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db, Like
+from flask.testing import FlaskClient
+
+from models import db, Message, User, connect_db, Like, Follows, TimelineEntry
+from querystats import assert_max_queries, count_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,10 +22,12 @@ from models import db, Message, User, connect_db, Like
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from likebuffer import like_buffer
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -27,6 +35,34 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
+# connect_db keeps one app context pushed for the whole module, and a request
+# made under it would reuse it (and its `g`); give each request its own, as it
+# gets under a real server, and read streamed pages in it too.
+
+class FreshContextClient(FlaskClient):
+    def run_wsgi_app(self, environ, buffered=False):
+        app_ctx = self.application.app_context()
+        with app_ctx:
+            app_iter, status, headers = super().run_wsgi_app(environ, buffered)
+        return self._read_in(app_ctx, app_iter), status, headers
+
+    @staticmethod
+    def _read_in(app_ctx, app_iter):
+        chunks = iter(app_iter)
+        try:
+            while True:
+                with app_ctx:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+app.test_client_class = FreshContextClient
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -83,6 +119,34 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             Message.query.filter_by(text="Hello").one()
 
+    def test_add_message_fans_out(self):
+        """ Tests that a new message lands in the author's and their
+        followers' timelines """
+
+        db.session.add(
+            Follows(user_being_followed_id=self.u1_id,
+                    user_following_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            msg = Message.query.filter_by(text="Hello").one()
+            timeline_user_ids = {
+                entry.user_id
+                for entry in TimelineEntry.query.filter_by(message_id=msg.id)
+            }
+
+            self.assertEqual(timeline_user_ids, {self.u1_id, self.u2_id})
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg.id).count(), 0)
+
     def test_add_message_page(self):
         """ Tests the messages/new page to display form if logged in """
         with self.client as c:
@@ -123,27 +187,104 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<p class="single-message">m1-text</p>', html)
 
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    """ Message search views """
+
+    def setUp(self):
+        super().setUp()
+
+        for day, text in enumerate(["warbling at dawn", "quiet day",
+                                    "more warbling today"], start=1):
+            msg = Message(
+                text=text,
+                user_id=self.u2_id,
+                timestamp=datetime(2022, 1, day))
+            msg.index_for_search()
+            db.session.add(msg)
+        db.session.commit()
+
+    def test_search_messages(self):
+        """ Test searching finds matching messages, newest first """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search?q=warbling")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Here is the message search page", html)
+            self.assertNotIn("quiet day", html)
+            self.assertLess(html.index("more warbling today"),
+                            html.index("warbling at dawn"))
+
+    def test_search_messages_pages(self):
+        """ Test paging through search results with ?before= """
+
+        with self.client as c, patch('app.MESSAGE_SEARCH_PAGE_SIZE', 1):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/messages/search?q=warbling").get_data(as_text=True)
+
+            self.assertIn("more warbling today", html)
+            self.assertNotIn("warbling at dawn", html)
+
+            next_url = html.split('href="/messages/search?q=')[1].split('"')[0]
+            html = c.get(f"/messages/search?q={next_url}").get_data(
+                as_text=True)
+
+            self.assertIn("warbling at dawn", html)
+            self.assertNotIn("more warbling today", html)
+            self.assertNotIn("More results", html)
+
+    def test_search_messages_wo_auth(self):
+        """ Test searching requires login """
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=warbling", follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Access unauthorized.", html)
+
+
 class MessageDeleteViewTestCase(MessageBaseViewTestCase):
     """ Delete related views """
 
     def test_delete_message_proper_user(self):
         """ Test deletion of user's own message """
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post(
+            f'/messages/{self.m1_id}/delete',
+            follow_redirects=True
+        )
+
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Message successfully deleted', html)
+        self.assertIn('Here is the user profile page', html)
+
+        self.assertIsNone(Message.query.get(self.m1_id))
+
+    def test_delete_message_updates_likers(self):
+        """ Test deleting a liked message takes it off likers' counts """
+
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        User.adjust_likes_counts({self.u2_id: 1})
+        db.session.commit()
+
         with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.post(
-                f'/messages/{self.m1_id}/delete',
-                follow_redirects=True
-            )
+            c.post(f'/messages/{self.m1_id}/delete')
 
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('Message successfully deleted', html)
-            self.assertIn('Here is the user profile page', html)
-
-            self.assertIsNone(Message.query.get(self.m1_id))
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+        self.assertEqual(Like.query.count(), 0)
 
     def test_delete_message_no_user(self):
         """ Test deletion of user's message if you are not logged in """
@@ -223,5 +364,246 @@ class MessageLikeViewTestCase(MessageBaseViewTestCase):
             self.assertIn('<p class="single-message">m1-text</p>', html)
             self.assertNotIn(m1, u2_likes)
 
+    def test_like_state_per_request(self):
+        """ Test like buttons reflect each request's user and latest likes """
+
+        like_url = f'/messages/{self.m1_id}/like'
+        unlike_url = f'/messages/{self.m1_id}/unlike'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get(f'/messages/{self.m1_id}').get_data(as_text=True)
+            self.assertIn(like_url, html)
+
+            resp = c.post(like_url,
+                data={"redirect_location":f"/messages/{self.m1_id}"},
+                follow_redirects=True)
+            html = resp.get_data(as_text=True)
+            self.assertIn(unlike_url, html)
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u3.id
+
+            html = c.get(f'/messages/{self.m1_id}').get_data(as_text=True)
+            self.assertIn(like_url, html)
+            self.assertNotIn(unlike_url, html)
+
+    def test_likes_buffered(self):
+        """ Test buffered clicks show at once and reach the db on flush """
+
+        data = {"redirect_location": f"/messages/{self.m1_id}"}
+
+        with self.client as c, patch.object(like_buffer, 'flush_interval', 3600):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f'/messages/{self.m1_id}/like',
+                          data=data, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f"/messages/{self.m1_id}/unlike", html)
+            self.assertEqual(Like.query.count(), 0)
+
+            # Only the last of several clicks is written
+            c.post(f'/messages/{self.m1_id}/unlike', data=data)
+            c.post(f'/messages/{self.m1_id}/like', data=data)
+            self.assertEqual(like_buffer.stats()['pending'], 1)
+
+            like_buffer.flush()
+            db.session.expire_all()
+
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+            self.assertEqual(like_buffer.stats()['pending'], 0)
+
+    def test_buffered_likes_on_own_pages(self):
+        """ Test the user's likes list and count include clicks still in the
+        buffer """
+
+        data = {"redirect_location": f"/messages/{self.m1_id}"}
+        likes_url = f'/users/{self.u2_id}/likes'
+        count = re.compile(rf"href='{likes_url}'>\s*(\d+)\s*<")
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        with patch.object(like_buffer, 'flush_interval', 3600):
+            self.client.post(f'/messages/{self.m1_id}/like', data=data)
+            self.assertEqual(Like.query.count(), 0)
+
+            html = self.client.get(likes_url).get_data(as_text=True)
+            self.assertIn('m1-text', html)
+
+            html = self.client.get(f'/users/{self.u2_id}').get_data(as_text=True)
+            self.assertEqual(count.search(html).group(1), '1')
+
+            like_buffer.flush()
+            self.client.post(f'/messages/{self.m1_id}/unlike', data=data)
+            self.assertEqual(Like.query.count(), 1)
+
+            html = self.client.get(likes_url).get_data(as_text=True)
+            self.assertNotIn('m1-text', html)
+
+            html = self.client.get(f'/users/{self.u2_id}').get_data(as_text=True)
+            self.assertEqual(count.search(html).group(1), '0')
+
+            like_buffer.flush()
+
+    def test_like_batch_counts_changed_rows(self):
+        """ Test a batch only counts the likes it actually adds or removes """
+
+        m2 = Message(text="m2-text", user_id=self.u1_id)
+        db.session.add(m2)
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+
+        Like.apply_batch({
+            (self.u2_id, self.m1_id): True,   # already liked
+            (self.u2_id, m2.id): True,
+            (self.u1_id, self.m1_id): False,  # never liked
+        })
+        db.session.commit()
+
+        self.assertEqual(Like.query.count(), 2)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+
+class MessageApiTestCase(MessageBaseViewTestCase):
+    """ Tests for the JSON API """
+
+    def test_api_requires_login(self):
+        """ Test the API answers 401 without a session """
+
+        with self.client as c:
+            resp = c.get('/api/v1/timeline')
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {'error': 'Not logged in.'})
+
+    def test_api_user_messages_paged(self):
+        """ Test paging through a user's messages by cursor """
+
+        for day in range(1, 4):
+            db.session.add(Message(
+                text=f"older-{day}",
+                user_id=self.u1_id,
+                timestamp=datetime(2020, 1, 4 - day)))
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f'/api/v1/users/{self.u1_id}/messages?limit=2')
+            page = resp.json
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [m['text'] for m in page['messages']], ['m1-text', 'older-1'])
+            self.assertTrue(page['messages'][0]['liked'])
+            self.assertEqual(page['messages'][0]['user']['username'], 'u1')
+
+            resp = c.get(f'/api/v1/users/{self.u1_id}/messages'
+                         f'?limit=2&before={page["next_cursor"]}')
+            page = resp.json
+
+            self.assertEqual(
+                [m['text'] for m in page['messages']], ['older-2', 'older-3'])
+            self.assertIsNone(page['next_cursor'])
+
+            resp = c.get(f'/api/v1/users/{self.u1_id}/messages?before=bad')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_timeline_and_message(self):
+        """ Test the timeline and single-message endpoints """
+
+        msg = Message.query.get(self.m1_id)
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/api/v1/timeline')
+
+            self.assertEqual(
+                [m['id'] for m in resp.json['messages']], [self.m1_id])
+
+            resp = c.get(f'/api/v1/messages/{self.m1_id}')
+
+            self.assertEqual(resp.json['text'], 'm1-text')
+            self.assertFalse(resp.json['liked'])
+
+            resp = c.get('/api/v1/messages/0')
+            self.assertEqual(resp.status_code, 404)
+
+
+class MessageViewQueryCountTestCase(MessageBaseViewTestCase):
+    """ Upper bounds on the number of queries each message view makes """
+
+    def assertViewQueries(self, limit, method, url, **kwargs):
+        """ Request `url` as u2 and check it runs at most `limit` queries """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            db.session.expire_all()
+
+            with assert_max_queries(limit):
+                resp = getattr(c, method)(url, **kwargs)
+                resp.get_data()
+
+            self.assertLess(resp.status_code, 400)
+
+    def test_show_message_queries(self):
+        self.assertViewQueries(5, 'get', f'/messages/{self.m1_id}')
+
+    def test_new_message_form_queries(self):
+        self.assertViewQueries(1, 'get', '/messages/new')
+
+    def test_current_user_cached(self):
+        """ Test the logged-in user is read from the cache between writes """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.get('/messages/new')
+            db.session.expire_all()
+
+            with count_queries() as stats:
+                resp = c.get('/messages/new')
+
+            self.assertIn('u2', resp.get_data(as_text=True))
+            self.assertEqual(stats.count, 0)
+
+            c.post('/users/profile', data={
+                "username": "u2-renamed",
+                "email": "u2@email.com",
+                "password": "password",
+            })
+            resp = c.get('/messages/new')
+
+            self.assertIn('u2-renamed', resp.get_data(as_text=True))
+
+    def test_add_message_queries(self):
+        self.assertViewQueries(
+            7, 'post', '/messages/new', data={"text": "Hello"})
 
+    def test_like_unlike_queries(self):
+        data = {"redirect_location": f"/messages/{self.m1_id}"}
 
+        self.assertViewQueries(
+            6, 'post', f'/messages/{self.m1_id}/like', data=data)
+        self.assertViewQueries(
+            7, 'post', f'/messages/{self.m1_id}/unlike', data=data)
@@ -5,20 +5,39 @@
 #    python -m unittest test_user_model.py
 
 
+import csv
 import os
+import tempfile
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import (db, User, Message, Follows, connect_db,
+from models import (db, User, Message, Follows, TimelineEntry, connect_db,
     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 
+from flask import Flask, session
+from sqlalchemy import create_engine, text
 from sqlalchemy.exc import IntegrityError
 
+from hashing import password_hasher
+from querystats import count_queries
+from cache import cache, LocalBackend, RedisBackend
+from bulkload import load_csvs, rebuild_derived
+from migrations import upgrade
+import routing
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 # Now we can import app
 
@@ -60,8 +79,8 @@ class UserModelTestCase(TestCase):
         u1 = User.query.get(self.u1_id)
 
         # User should have no messages & no followers
-        self.assertEqual(len(u1.messages), 0)
-        self.assertEqual(len(u1.followers), 0)
+        self.assertEqual(u1.messages.count(), 0)
+        self.assertEqual(u1.followers.count(), 0)
 
     def test_default_images(self):
         """ Test population of default images on signup """
@@ -104,6 +123,64 @@ class UserModelTestCase(TestCase):
         self.assertFalse(u2.is_followed_by(u1))
 
 
+    def test_following_and_follower_ids(self):
+        """ Test the batch follow-state lookups """
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(u1.following_ids([u1.id, u2.id]), {u2.id})
+        self.assertEqual(u1.follower_ids([u1.id, u2.id]), set())
+        self.assertEqual(u2.follower_ids([u1.id, u2.id]), {u1.id})
+        self.assertEqual(u2.following_ids([]), set())
+
+    def test_append_without_loading(self):
+        """ Test appending to a collection doesn't load the collection """
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        db.session.add_all(
+            [Message(text=f"m{i}", user_id=self.u2_id) for i in range(5)])
+        db.session.commit()
+
+        # Reload the users (expired by the commit) outside the counted block
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+
+        with count_queries() as stats:
+            u1.following.append(u2)
+            u1.liked_messages.append(Message.query.filter_by(text="m0").one())
+            db.session.flush()
+
+        # The message lookup, then one INSERT each into follows and likes
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(u1.following.count(), 1)
+
+    def test_recount(self):
+        """ Test User.recount rebuilds the denormalized counters """
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.add(Message(text="hi", user_id=self.u1_id))
+        db.session.commit()
+
+        # Relationship appends bypass the counters until repaired
+        self.assertEqual(u1.following_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.followers_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.messages_count, 0)
+
     def test_user_signup_method(self):
         """ creates a user and tests that the user is created
         with the correct information """
@@ -115,10 +192,10 @@ class UserModelTestCase(TestCase):
         u3_in_db = User.query.get(u3.id)
 
         self.assertEqual(u3, u3_in_db)
-        self.assertEqual(len(u3_in_db.messages), 0)
-        self.assertEqual(len(u3_in_db.followers), 0)
-        self.assertEqual(len(u3_in_db.following), 0)
-        self.assertEqual(len(u3_in_db.liked_messages), 0)
+        self.assertEqual(u3_in_db.messages.count(), 0)
+        self.assertEqual(u3_in_db.followers.count(), 0)
+        self.assertEqual(u3_in_db.following.count(), 0)
+        self.assertEqual(u3_in_db.liked_messages.count(), 0)
         self.assertNotEqual('password', u3_in_db.password)
 
     def test_invalid_user_signups(self):
@@ -187,4 +264,257 @@ class UserModelTestCase(TestCase):
         # Invalid password
         invalid_pwd_auth = User.authenticate('u1', 'not_password')
 
-        self.assertFalse(invalid_pwd_auth)
\ No newline at end of file
+        self.assertFalse(invalid_pwd_auth)
+
+    def test_user_authenticate_rehashes(self):
+        """ Test authenticate upgrades hashes made with an old work factor """
+
+        with patch.object(password_hasher, 'rounds', 4):
+            user = User.authenticate('u1', 'password')
+
+            self.assertTrue(user.password.startswith('$2b$04$'))
+            self.assertFalse(password_hasher.needs_rehash(user.password))
+
+        db.session.commit()
+
+        self.assertEqual(User.authenticate('u1', 'password'), user)
+
+    def test_get_cached(self):
+        """ Test cached user lookups and their invalidation """
+
+        backends = [LocalBackend()]
+        if fakeredis:
+            backends.append(RedisBackend(client=fakeredis.FakeRedis()))
+
+        for backend in backends:
+            with self.subTest(backend=type(backend).__name__), \
+                    patch.object(cache, 'backend', backend):
+                cache.clear()
+
+                db.session.expire_all()
+                self.assertEqual(User.get_cached(self.u1_id).username, 'u1')
+                db.session.expunge_all()
+                user = User.get_cached(self.u1_id)
+
+                self.assertEqual(user.username, 'u1')
+                self.assertEqual(cache.stats()['user']['hits'], 1)
+                likes_count = user.likes_count
+
+                # Not cached, but loaded on demand
+                self.assertTrue(user.password.startswith('$2b$'))
+
+                User.adjust_counts(self.u1_id, likes_count=3)
+                db.session.commit()
+                db.session.expunge_all()
+
+                self.assertEqual(
+                    User.get_cached(self.u1_id).likes_count, likes_count + 3)
+                self.assertEqual(cache.stats()['user']['misses'], 2)
+
+                self.assertIsNone(User.get_cached(0))
+
+
+class ReadReplicaTestCase(TestCase):
+    """ Tests for sending reads to a replica """
+
+    def setUp(self):
+        """ Set up an app with a second database as its replica """
+
+        self.replica_app = Flask(__name__)
+        self.replica_app.config.update(
+            SECRET_KEY='replica-test',
+            SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+            SQLALCHEMY_BINDS={
+                'replica0': "postgresql:///warbler_test_replica",
+            },
+        )
+        db.init_app(self.replica_app)
+        routing.init_app(self.replica_app)
+
+        # A user that only the replica has
+        with self.replica_app.app_context():
+            replica = db.engines['replica0']
+            db.metadata.drop_all(replica)
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), {
+                    'username': 'replica-only',
+                    'email': 'replica@email.com',
+                    'password': 'not-a-hash',
+                })
+
+    def replica_has_user(self, method='GET', pinned=False, write=False):
+        """ Does a request with these properties read from the replica? """
+
+        with self.replica_app.test_request_context('/', method=method):
+            if pinned:
+                session['primary_until'] = time.time() + 5
+            self.replica_app.preprocess_request()
+
+            if write:
+                Message.query.filter(Message.id == 0).delete()
+
+            return bool(User.query.filter_by(username='replica-only').count())
+
+    def test_reads_routed(self):
+        """ Test GETs read from the replica unless a write needs the primary """
+
+        self.assertTrue(self.replica_has_user())
+        self.assertFalse(self.replica_has_user(method='POST'))
+        self.assertFalse(self.replica_has_user(pinned=True))
+        self.assertFalse(self.replica_has_user(write=True))
+
+    def test_writer_pinned(self):
+        """ Test a request that writes pins the session to the primary """
+
+        with self.replica_app.test_request_context('/', method='POST'):
+            self.replica_app.preprocess_request()
+            Message.query.filter(Message.id == 0).delete()
+            self.replica_app.process_response(
+                self.replica_app.response_class())
+
+            self.assertGreater(session['primary_until'], time.time())
+
+
+class BulkLoadTestCase(TestCase):
+    """ Tests for loading CSV files with bulkload """
+
+    def setUp(self):
+        """ Write a small dataset to CSV files """
+
+        User.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        self.paths = {}
+
+        for table, rows in {
+            'users': [
+                ['id', 'email', 'username', 'password', 'bio'],
+                ['1001', 'a@email.com', 'alice', 'not-a-hash', 'Hi, "all"'],
+                ['1002', 'b@email.com', 'bob', 'not-a-hash', ''],
+            ],
+            'messages': [
+                ['text', 'timestamp', 'user_id'],
+                ['First', '2017-01-21 11:04:53.522807', '1001'],
+                ['Second, with a comma', '2017-01-22 11:04:53', '1001'],
+            ],
+            'follows': [
+                ['user_being_followed_id', 'user_following_id'],
+                ['1001', '1002'],
+            ],
+        }.items():
+            self.paths[table] = os.path.join(self.dir, f'{table}.csv')
+            with open(self.paths[table], 'w', newline='') as f:
+                csv.writer(f).writerows(rows)
+
+    def tearDown(self):
+        """ Tear down after each test """
+
+        db.session.rollback()
+
+    def test_load_csvs(self):
+        """ Test rows are loaded and derived data rebuilt """
+
+        load_csvs(self.paths, chunk_size=1, echo=lambda line: None)
+        db.session.expire_all()
+
+        alice = User.query.get(1001)
+        bob = User.query.get(1002)
+
+        self.assertEqual(alice.image_url, DEFAULT_IMAGE_URL)
+        self.assertEqual(alice.bio, 'Hi, "all"')
+        self.assertIsNone(bob.bio)
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertEqual(bob.following_count, 1)
+
+        messages, _ = TimelineEntry.messages_for(bob.id)
+        self.assertEqual(
+            [msg.text for msg in messages], ['Second, with a comma', 'First'])
+
+        # New rows are numbered after the loaded ones
+        carol = User.signup("carol", "c@email.com", "password", None)
+        db.session.commit()
+        self.assertGreater(carol.id, 1002)
+
+
+    def test_rebuild_derived_chunked(self):
+        """ Test timelines are rebuilt a chunk of users at a time, with each
+        followed user's newest messages only """
+
+        load_csvs(self.paths, echo=lambda line: None)
+
+        progress = []
+        rebuild_derived(chunk_size=1, limit=1, echo=progress.append)
+
+        self.assertEqual(progress, [
+            "timelines and counters: 1 users",
+            "timelines and counters: 2 users",
+        ])
+
+        # Bob gets the newest of Alice's messages; Alice keeps all her own
+        messages, _ = TimelineEntry.messages_for(1002)
+        self.assertEqual([msg.text for msg in messages], ['Second, with a comma'])
+
+        messages, _ = TimelineEntry.messages_for(1001)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(User.query.get(1001).messages_count, 2)
+
+
+class MigrationTestCase(TestCase):
+    """ Tests for upgrading an existing database """
+
+    def setUp(self):
+        """ Build the schema as it was before any migrations """
+
+        self.engine = create_engine("postgresql:///warbler_test_migrations")
+        self.addCleanup(self.engine.dispose)
+        db.metadata.drop_all(self.engine)
+
+        with self.engine.begin() as conn:
+            for ddl in (
+                'CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                'email TEXT NOT NULL UNIQUE, username TEXT NOT NULL UNIQUE, '
+                'image_url TEXT, header_image_url TEXT, bio TEXT, '
+                'location TEXT, password TEXT NOT NULL)',
+                'CREATE TABLE messages (id INTEGER PRIMARY KEY, '
+                'text VARCHAR(140) NOT NULL, timestamp TIMESTAMP NOT NULL, '
+                'user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE)',
+                'CREATE TABLE follows (user_being_followed_id INTEGER '
+                'REFERENCES users ON DELETE CASCADE, user_following_id INTEGER '
+                'REFERENCES users ON DELETE CASCADE, '
+                'PRIMARY KEY (user_being_followed_id, user_following_id))',
+                'CREATE TABLE likes (user_id INTEGER REFERENCES users '
+                'ON DELETE CASCADE, message_id INTEGER REFERENCES messages '
+                'ON DELETE CASCADE, PRIMARY KEY (user_id, message_id))',
+                "INSERT INTO users (id, email, username, password) VALUES "
+                "(1, 'a@email.com', 'a', 'x'), (2, 'b@email.com', 'b', 'x')",
+                "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+                "(1, 'hello', '2020-01-01 00:00:00', 1)",
+                'INSERT INTO follows VALUES (1, 2)',
+                'INSERT INTO likes VALUES (2, 1)',
+            ):
+                conn.execute(text(ddl))
+
+    def tearDown(self):
+        """ Drop the upgraded schema """
+
+        db.metadata.drop_all(self.engine)
+
+    def test_upgrade_backfills(self):
+        """ Test upgrading fills in counters and timelines """
+
+        upgrade(self.engine, echo=lambda line: None)
+
+        with self.engine.connect() as conn:
+            counts = conn.execute(text(
+                'SELECT id, messages_count, followers_count, '
+                'following_count, likes_count FROM users ORDER BY id')).all()
+            timelines = conn.execute(text(
+                'SELECT user_id, message_id FROM timeline_entries '
+                'ORDER BY user_id')).all()
+
+        self.assertEqual(
+            [tuple(row) for row in counts], [(1, 1, 1, 0, 0), (2, 0, 0, 1, 1)])
+        self.assertEqual([tuple(row) for row in timelines], [(1, 1), (2, 1)])
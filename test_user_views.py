@@ -6,11 +6,20 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db, Like, Follows, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from flask.testing import FlaskClient
 
-from flask import session
+from models import db, Message, User, connect_db, Like, Follows, TimelineEntry, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+
+from flask import session, current_app, request
+
+from querystats import assert_max_queries
+from hashing import password_hasher
+from fragments import fragment_cache
+from cache import cache, LocalBackend, RedisBackend
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -18,10 +27,11 @@ from flask import session
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, create_app, CURR_USER_KEY
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -29,6 +39,34 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
+# connect_db keeps one app context pushed for the whole module, and a request
+# made under it would reuse it (and its `g`); give each request its own, as it
+# gets under a real server, and read streamed pages in it too.
+
+class FreshContextClient(FlaskClient):
+    def run_wsgi_app(self, environ, buffered=False):
+        app_ctx = self.application.app_context()
+        with app_ctx:
+            app_iter, status, headers = super().run_wsgi_app(environ, buffered)
+        return self._read_in(app_ctx, app_iter), status, headers
+
+    @staticmethod
+    def _read_in(app_ctx, app_iter):
+        chunks = iter(app_iter)
+        try:
+            while True:
+                with app_ctx:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+app.test_client_class = FreshContextClient
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -82,6 +120,57 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Here is the user listing page', html)
 
+    def test_user_show_conditional_get(self):
+        """ Test a profile is a 304 until the profile or viewer changes """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get(f'/users/{self.u2_id}')
+        resp.get_data()
+        etag = resp.headers['ETag']
+
+        resp = self.client.get(
+            f'/users/{self.u2_id}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.client.post(f'/users/follow/{self.u2_id}')
+
+        resp = self.client.get(
+            f'/users/{self.u2_id}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        resp.get_data()
+
+    def test_user_show_message_fragments_cached(self):
+        """ Test message items render once per author profile version """
+
+        fragment_cache.clear()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        for _ in range(2):
+            html = self.client.get(f'/users/{self.u1_id}').get_data(as_text=True)
+            self.assertIn('m1-text', html)
+            self.assertIn(f'/messages/{self.m1_id}/like', html)
+
+        stats = fragment_cache.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 1))
+
+        # Counter writes bump updated_at but leave the fragment alone
+        User.adjust_counts(self.u1_id, likes_count=1)
+        db.session.commit()
+
+        self.client.get(f'/users/{self.u1_id}').get_data()
+        self.assertEqual(fragment_cache.stats()['misses'], 1)
+
+        User.query.get(self.u1_id).image_url = '/new-avatar.png'
+        db.session.commit()
+
+        html = self.client.get(f'/users/{self.u1_id}').get_data(as_text=True)
+        self.assertIn('/new-avatar.png', html)
+        self.assertEqual(fragment_cache.stats()['misses'], 2)
+
     def test_users_listing_w_query(self):
         """ Test GET /users route with query string with login """
 
@@ -96,6 +185,50 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertIn('Here is the user listing page', html)
             self.assertNotIn('u2', html)
 
+    def test_users_search_ranked_and_paged(self):
+        """ Test username search ranks closer matches first and pages """
+
+        for username in ["xxbirdxx", "bird", "birdy"]:
+            db.session.add(User(
+                username=username,
+                email=f"{username}@email.com",
+                password="not-a-real-hash"))
+        db.session.commit()
+
+        with self.client as c, patch('app.USERS_PAGE_SIZE', 2):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/users?q=bird').get_data(as_text=True)
+
+            self.assertLess(html.index('@bird<'), html.index('@birdy<'))
+            self.assertNotIn('@xxbirdxx<', html)
+            self.assertIn('/users?q=bird&amp;page=2', html)
+
+            html = c.get('/users?q=bird&page=2').get_data(as_text=True)
+
+            self.assertIn('@xxbirdxx<', html)
+            self.assertNotIn('@birdy<', html)
+
+    def test_users_listing_pages(self):
+        """ Test browsing users a page at a time in username order """
+
+        with self.client as c, patch('app.USERS_PAGE_SIZE', 1):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/users').get_data(as_text=True)
+
+            self.assertIn('<p>@u1</p>', html)
+            self.assertNotIn('<p>@u2</p>', html)
+            self.assertIn('href="/users?after=u1"', html)
+
+            html = c.get('/users?after=u1').get_data(as_text=True)
+
+            self.assertIn('<p>@u2</p>', html)
+            self.assertNotIn('<p>@u1</p>', html)
+            self.assertNotIn('Next', html)
+
     def test_users_listing_wo_auth(self):
         """ Test accessing /users route without authorization """
 
@@ -112,16 +245,15 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
     def test_user_profile(self):
         """ Test user profile page with login """
 
-        with self.client as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1_id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.get(f'/users/{self.u2_id}')
-            html = resp.get_data(as_text=True)
+        resp = self.client.get(f'/users/{self.u2_id}')
+        html = resp.get_data(as_text=True)
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('Here is the user profile page', html)
-            self.assertIn('<h4 id="sidebar-username">@u2</h4>', html)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Here is the user profile page', html)
+        self.assertIn('<h4 id="sidebar-username">@u2</h4>', html)
 
 
 class UserFollowViewTestCase(UserBaseViewTestCase):
@@ -130,22 +262,36 @@ class UserFollowViewTestCase(UserBaseViewTestCase):
     def test_user_following_page(self):
         """ Test GET /users/<user_id>/following """
 
-        with self.client as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1_id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
 
-            u1 = User.query.get(self.u1_id)
-            u2 = User.query.get(self.u2_id)
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
 
-            u2.following.append(u1)
-            db.session.commit()
+        u2.following.append(u1)
+        db.session.commit()
 
-            resp = c.get(f'/users/{self.u2_id}/following')
-            html = resp.get_data(as_text=True)
+        resp = self.client.get(f'/users/{self.u2_id}/following')
+        html = resp.get_data(as_text=True)
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('<p>@u1</p>', html)
-            self.assertIn('Here is the following page', html)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<p>@u1</p>', html)
+        self.assertIn('Here is the following page', html)
+
+    def test_user_followers_page_streams(self):
+        """ Test the followers page is streamed """
+
+        u1 = User.query.get(self.u1_id)
+        u1.following.append(User.query.get(self.u2_id))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get(f'/users/{self.u2_id}/followers')
+
+        self.assertTrue(resp.is_streamed)
+        self.assertIn('<p>@u1</p>', resp.get_data(as_text=True))
 
     def test_user_following_page_wo_auth(self):
         """ Test accessing /users/<user_id>/following route without authorization """
@@ -160,25 +306,52 @@ class UserFollowViewTestCase(UserBaseViewTestCase):
             self.assertIn('<p>Sign up now to get your own personalized timeline!</p>', html)
             self.assertIn("Access unauthorized.", html)
 
-    def test_user_followers_page(self):
-        """ Test GET /users/<user_id>/followers """
+    def test_follow_unfollow_idempotent(self):
+        """ Test repeated follows and unfollows are harmless no-ops """
 
         with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            u1 = User.query.get(self.u1_id)
-            u2 = User.query.get(self.u2_id)
+            for _ in range(2):
+                resp = c.post(f'/users/follow/{self.u2_id}')
+                self.assertEqual(resp.status_code, 302)
 
-            u1.following.append(u2)
-            db.session.commit()
+            db.session.expire_all()
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
 
-            resp = c.get(f'/users/{self.u2_id}/followers')
-            html = resp.get_data(as_text=True)
+            for _ in range(2):
+                resp = c.post(f'/users/stop-following/{self.u2_id}')
+                self.assertEqual(resp.status_code, 302)
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('<p>@u1</p>', html)
-            self.assertIn('Here is the followers page', html)
+            db.session.expire_all()
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+            resp = c.post('/users/follow/0')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_followers_page(self):
+        """ Test GET /users/<user_id>/followers """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        resp = self.client.get(f'/users/{self.u2_id}/followers')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<p>@u1</p>', html)
+        self.assertIn('Here is the followers page', html)
 
     def test_user_followers_page_wo_auth(self):
         """ Test accessing /users/<user_id>/followers route without authorization """
@@ -196,41 +369,131 @@ class UserFollowViewTestCase(UserBaseViewTestCase):
     def test_follow_user_post(self):
         """ Test POST route to follow a user """
 
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post(f'/users/follow/{self.u2_id}', follow_redirects=True)
+        html = resp.get_data(as_text=True)
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<p>@u2</p>', html)
+        self.assertIn('Here is the following page', html)
+        self.assertIn(u1, u2.followers)
+
+    def test_follow_backfills_timeline(self):
+        """ Test that following a user adds their messages to the home
+        timeline and unfollowing removes them """
+
         with self.client as c:
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1_id
+                sess[CURR_USER_KEY] = self.u2_id
 
-            resp = c.post(f'/users/follow/{self.u2_id}', follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            c.post(f'/users/follow/{self.u1_id}')
+            html = c.get('/').get_data(as_text=True)
+
+            self.assertIn('m1-text', html)
+
+            c.post(f'/users/stop-following/{self.u1_id}')
+            html = c.get('/').get_data(as_text=True)
+
+            self.assertNotIn('m1-text', html)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 0)
+
+    def test_follow_self(self):
+        """ Test following or unfollowing yourself is refused and leaves the
+        timeline working """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post(
+            f'/users/follow/{self.u1_id}', follow_redirects=True)
+
+        self.assertIn("follow yourself", resp.get_data(as_text=True))
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+
+        resp = self.client.post(f'/users/stop-following/{self.u1_id}')
+        self.assertEqual(resp.status_code, 302)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertNotIn(f'/users/follow/{self.u1_id}"', html)
+        self.assertIn(f'/users/follow/{self.u2_id}"', html)
+
+        # A self-follow already in the table doesn't double the author's
+        # own timeline entry
+        db.session.add(Follows(
+            user_being_followed_id=self.u1_id,
+            user_following_id=self.u1_id))
+        db.session.commit()
+
+        resp = self.client.post('/messages/new', data={'text': 'still works'})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 1)
+
+    def test_follow_updates_counters(self):
+        """ Test that following and unfollowing keep the counters in sync """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/users/follow/{self.u1_id}')
 
             u1 = User.query.get(self.u1_id)
             u2 = User.query.get(self.u2_id)
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('<p>@u2</p>', html)
-            self.assertIn('Here is the following page', html)
-            self.assertIn(u1, u2.followers)
+            self.assertEqual(u1.followers_count, 1)
+            self.assertEqual(u2.following_count, 1)
 
-    def test_unfollow_user_post(self):
-        """ Test POST route to unfollow a user """
+            c.post(f'/users/stop-following/{self.u1_id}')
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+
+            self.assertEqual(u1.followers_count, 0)
+            self.assertEqual(u2.following_count, 0)
+
+    def test_follow_state_per_request(self):
+        """ Test follow buttons reflect each request's latest follows """
+
+        unfollow_action = f'action="/users/stop-following/{self.u2_id}"'
 
         with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            u1 = User.query.get(self.u1_id)
-            u2 = User.query.get(self.u2_id)
+            self.assertNotIn(unfollow_action, c.get('/users').get_data(as_text=True))
 
-            u2.followers.append(u1)
-            db.session.commit()
+            c.post(f'/users/follow/{self.u2_id}')
 
-            resp = c.post(f'/users/stop-following/{self.u2_id}', follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            self.assertIn(unfollow_action, c.get('/users').get_data(as_text=True))
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertNotIn('<p>@u2</p>', html)
-            self.assertIn('Here is the following page', html)
-            self.assertNotIn(u1, u2.followers)
+    def test_unfollow_user_post(self):
+        """ Test POST route to unfollow a user """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u2.followers.append(u1)
+        db.session.commit()
+
+        resp = self.client.post(f'/users/stop-following/{self.u2_id}', follow_redirects=True)
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('<p>@u2</p>', html)
+        self.assertIn('Here is the following page', html)
+        self.assertNotIn(u1, u2.followers)
 
 class UserUpdateViewTestCase(UserBaseViewTestCase):
     """ Tests for updating a user """
@@ -255,32 +518,31 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
     def test_update_user_form_submit(self):
         """ Test submission of user update form """
 
-        with self.client as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1_id
-
-            d={
-                "username": 'u1',
-                "email": 'u1new@email.com',
-                "image_url": DEFAULT_IMAGE_URL,
-                "header_image_url": DEFAULT_HEADER_IMAGE_URL,
-                "bio": 'what bio',
-                "location": 'Hawaii',
-                "password": "password"
-            }
-            resp = c.post('/users/profile', data=d, follow_redirects=True)
-            html = resp.get_data(as_text=True)
-
-            u1 = User.query.get(self.u1_id)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('Here is the user profile page', html)
-            self.assertIn('Hawaii', html)
-            self.assertIn('what bio', html)
-            self.assertEqual(u1.location, 'Hawaii')
-            self.assertEqual(u1.bio, 'what bio')
-            self.assertEqual(u1.email, 'u1new@email.com')
-            self.assertEqual(u1.username, 'u1')
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        d={
+            "username": 'u1',
+            "email": 'u1new@email.com',
+            "image_url": DEFAULT_IMAGE_URL,
+            "header_image_url": DEFAULT_HEADER_IMAGE_URL,
+            "bio": 'what bio',
+            "location": 'Hawaii',
+            "password": "password"
+        }
+        resp = self.client.post('/users/profile', data=d, follow_redirects=True)
+        html = resp.get_data(as_text=True)
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Here is the user profile page', html)
+        self.assertIn('Hawaii', html)
+        self.assertIn('what bio', html)
+        self.assertEqual(u1.location, 'Hawaii')
+        self.assertEqual(u1.bio, 'what bio')
+        self.assertEqual(u1.email, 'u1new@email.com')
+        self.assertEqual(u1.username, 'u1')
 
 class UserDeleteViewTestCase(UserBaseViewTestCase):
     """ Tests for deleting a user """
@@ -319,20 +581,19 @@ class UserLikesListTestCase(UserBaseViewTestCase):
     def test_user_likes_page(self):
         """ Test GET to /users/<int:user_id>/likes """
 
-        with self.client as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1_id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
 
-            m1 = Message.query.get(self.m1_id)
-            u1 = User.query.get(self.u1_id)
-            u1.liked_messages.append(m1)
-            db.session.commit()
+        m1 = Message.query.get(self.m1_id)
+        u1 = User.query.get(self.u1_id)
+        u1.liked_messages.append(m1)
+        db.session.commit()
 
-            resp = c.get(f"/users/{self.u1_id}/likes")
-            html = resp.get_data(as_text=True)
+        resp = self.client.get(f"/users/{self.u1_id}/likes")
+        html = resp.get_data(as_text=True)
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('m1-text', html)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('m1-text', html)
 
 class UserSignupTestCase(UserBaseViewTestCase):
     """ Tests for when a user attempts to signup or visit the signup page """
@@ -461,6 +722,47 @@ class UserLoginViewTestCase(UserBaseViewTestCase):
             self.assertIn('Invalid credentials', html)
             self.assertNotIn(CURR_USER_KEY, session)
 
+    def test_login_throttled(self):
+        """ Test repeated logins for one username get a 429 """
+
+        with self.client as c, patch.dict(
+                app.config, {'LOGIN_THROTTLE_USERNAME': (1, 60)}):
+            d = {
+                "username": "u2",
+                "password": "wrong-password",
+            }
+
+            resp = c.post('/login', data=d)
+            self.assertEqual(resp.status_code, 302)
+
+            d["password"] = "password"
+            resp = c.post('/login', data=d)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers['Retry-After'], '60')
+            self.assertIn('Too many login attempts', html)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+    def test_login_when_hashing_pool_saturated(self):
+        """ Test logins are shed with a 503 when the hashing pool is full """
+
+        with self.client as c, patch.object(password_hasher, 'max_pending', 0):
+            d = {
+                "username": "u1",
+                "password": "password",
+            }
+
+            resp = c.post('/login', data=d)
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            self.assertNotIn(CURR_USER_KEY, session)
+
+            stats = c.get('/metrics/hashing').json
+            self.assertGreaterEqual(stats['rejected'], 1)
+            self.assertEqual(stats['pending'], 0)
+
 
 class UserLogoutViewTestCase(UserBaseViewTestCase):
     """ Tests for logging out a user """
@@ -500,6 +802,109 @@ class UserHomepageViewTestCase(UserBaseViewTestCase):
             self.assertIn('<p>@u1</p>', html)
 
 
+    def test_user_homepage_pagination(self):
+        """ Test paging through the home timeline with ?before= cursors """
+
+        for day in range(1, 4):
+            msg = Message(
+                text=f"older-{day}",
+                user_id=self.u1_id,
+                timestamp=datetime(2020, 1, 1) - timedelta(days=day))
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        with self.client as c, patch('app.TIMELINE_PAGE_SIZE', 2):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('older-1', html)
+            self.assertIn('older-2', html)
+            self.assertNotIn('older-3', html)
+            self.assertIn('id="load-more"', html)
+
+            cursor = html.split('data-cursor="')[1].split('"')[0]
+            resp = c.get(f'/timeline?before={cursor}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('older-3', html)
+            self.assertNotIn('older-2', html)
+            self.assertNotIn('<!-- Here is the home page -->', html)
+            self.assertNotIn('X-Next-Cursor', resp.headers)
+
+    def test_user_homepage_conditional_get(self):
+        """ Test the home page is a 304 until the timeline changes """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/')
+            etag = resp.headers['ETag']
+
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            msg = Message(text="fresh", user_id=self.u1_id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+            db.session.commit()
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('fresh', resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+            # Pages without an ETag of their own don't pick up this one
+            resp = c.get('/users')
+            resp.get_data()
+
+            self.assertNotIn('ETag', resp.headers)
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    def test_fingerprinted_static_files(self):
+        """ Test static files are linked by fingerprint and cached """
+
+        with self.client as c:
+            html = c.get('/').get_data(as_text=True)
+            url = html.split('href="/static/stylesheets/')[1].split('"')[0]
+            url = '/static/stylesheets/' + url
+
+            self.assertIn('/static/stylesheets/style.css?v=', url)
+
+            resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            cache_control = resp.headers['Cache-Control']
+            self.assertIn('immutable', cache_control)
+            self.assertIn('max-age=31536000', cache_control)
+            self.assertNotIn('no-cache', cache_control)
+            self.assertNotIn('no-store', cache_control)
+            resp.close()
+
+    def test_user_homepage_bad_cursor(self):
+        """ Test that a malformed cursor is a bad request """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/?before=not-a-cursor')
+
+            self.assertEqual(resp.status_code, 400)
+
     def test_user_homepage_logged_out(self):
         """ Test homepage for logged out user """
 
@@ -511,4 +916,136 @@ class UserHomepageViewTestCase(UserBaseViewTestCase):
             self.assertIn(
                 '<p>Sign up now to get your own personalized timeline!</p>',
                 html
-            )
\ No newline at end of file
+            )
+
+class UserViewQueryCountTestCase(UserBaseViewTestCase):
+    """ Upper bounds on the number of queries each user view makes """
+
+    def setUp(self):
+        """ Give u1 a handful of followers, follows, messages and likes, so
+        that per-item queries push the count past the bound.
+
+        Budgets are a fixed handful of queries per page, not per item on it.
+        """
+
+        super().setUp()
+
+        u1 = User.query.get(self.u1_id)
+
+        for i in range(5):
+            user = User(
+                username=f"f{i}",
+                email=f"f{i}@email.com",
+                password="not-a-real-hash")
+            db.session.add(user)
+            db.session.flush()
+
+            u1.followers.append(user)
+            u1.following.append(user)
+
+            msg = Message(text=f"f{i}-text", user_id=user.id)
+            msg.index_for_search()
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+            u1.liked_messages.append(msg)
+
+        db.session.commit()
+
+    def test_view_query_counts(self):
+        """ Test each view stays within its query budget """
+
+        budgets = [
+            ('/', 4),
+            ('/users', 3),
+            ('/users?q=f', 4),
+            ('/messages/search?q=text', 3),
+            (f'/users/{self.u1_id}', 3),
+            (f'/users/{self.u2_id}', 4),
+            (f'/users/{self.u1_id}/following', 3),
+            (f'/users/{self.u1_id}/followers', 3),
+            (f'/users/{self.u1_id}/likes', 3),
+            ('/users/profile', 1),
+        ]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        for url, limit in budgets:
+            with self.subTest(url=url):
+                db.session.expire_all()
+
+                # Read the body inside the block: streamed pages keep
+                # querying as they render
+                with assert_max_queries(limit):
+                    resp = self.client.get(url)
+                    resp.get_data()
+
+                self.assertEqual(resp.status_code, 200)
+
+    def test_query_stats_headers(self):
+        """ Test query stats are sent back in headers when enabled """
+
+        with self.client as c, patch.dict(app.config, QUERY_STATS_HEADERS=True):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/users')
+
+            self.assertIn('X-Query-Count', resp.headers)
+            self.assertIn('X-Query-Time-Ms', resp.headers)
+
+        resp = self.client.get('/users')
+
+        self.assertNotIn('X-Query-Count', resp.headers)
+
+
+class AppFactoryTestCase(TestCase):
+    @patch.dict(os.environ, CACHE_URL='redis://localhost:6379/0')
+    def test_production_profile(self):
+        """ Test the production app has no toolbar and pushes no context """
+
+        prod_app = create_app('production')
+
+        self.assertNotIn('debugtoolbar', prod_app.extensions)
+        self.assertIn('sqlalchemy', prod_app.extensions)
+        self.assertFalse(prod_app.testing)
+        self.assertIsNot(current_app._get_current_object(), prod_app)
+        self.assertIsInstance(prod_app.extensions['cache'].backend, RedisBackend)
+
+        # The test app keeps its own extensions
+        for name in ('cache', 'fragment_cache', 'like_buffer',
+                     'password_hasher'):
+            self.assertIsNot(
+                prod_app.extensions[name], app.extensions[name])
+        self.assertIsInstance(cache.backend, LocalBackend)
+
+        resp = prod_app.test_client().get('/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Happening?", resp.get_data(as_text=True))
+
+    @patch.dict(os.environ, CACHE_URL='redis://localhost:6379/0')
+    def test_production_client_address(self):
+        """ Test production takes the client's address from the router's
+        X-Forwarded-For entry, and only that one """
+
+        prod_app = create_app('production')
+        prod_app.add_url_rule('/remote-addr', 'remote_addr',
+                              lambda: request.remote_addr)
+
+        resp = prod_app.test_client().get(
+            '/remote-addr',
+            headers={'X-Forwarded-For': '10.0.0.1, 203.0.113.7'},
+            environ_base={'REMOTE_ADDR': '10.1.2.3'})
+
+        self.assertEqual(resp.get_data(as_text=True), '203.0.113.7')
+
+    def test_production_requires_shared_cache(self):
+        """ Test the production profile won't start without CACHE_URL """
+
+        with patch.dict(os.environ):
+            os.environ.pop('CACHE_URL', None)
+
+            with self.assertRaises(KeyError):
+                create_app('production')
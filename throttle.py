@@ -0,0 +1,158 @@
+"""Login throttling with token buckets in shared memory.
+
+Every /login attempt costs a bcrypt check, so attempts are rate-limited per
+username and per client IP *before* the password is checked. The buckets
+live in a fixed-size hash table in a memory-mapped file, so every gunicorn
+worker on the machine sees (and spends from) the same buckets without an
+external service.
+
+The client IP is request.remote_addr; behind a proxy, set
+TRUSTED_PROXY_HOPS (see config.py) so that it isn't the proxy's.
+
+Each slot is (key hash, tokens, last update). Keys are placed by open
+addressing over a short probe window; when the window is full the least
+recently touched slot is recycled, which at worst forgets an old bucket.
+
+Configuration:
+
+- LOGIN_THROTTLE_ENABLED: turn throttling on or off (default on).
+- LOGIN_THROTTLE_PATH: the shared table's file; defaults to one in /dev/shm
+  (or the temp directory).
+- LOGIN_THROTTLE_USERNAME, LOGIN_THROTTLE_IP: (burst, seconds per token).
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from hashlib import blake2b
+
+from flask import current_app
+
+SLOT = struct.Struct('=Qdd')
+NUM_SLOTS = 8192
+PROBE_WINDOW = 8
+
+
+def default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'warbler-login-throttle')
+
+
+class BucketTable:
+    """Token buckets in a memory-mapped file shared between processes."""
+
+    def __init__(self, path, num_slots=NUM_SLOTS):
+        self.num_slots = num_slots
+        self._thread_lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = SLOT.size * num_slots
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key):
+        digest = blake2b(key.encode('utf-8'), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, 'little') or 1
+
+    def take(self, key, burst, seconds_per_token, now=None):
+        """Spend a token from `key`'s bucket.
+
+        Returns 0 if a token was available, otherwise how many seconds until
+        one will be.
+        """
+
+        now = time.time() if now is None else now
+        key_hash = self._hash(key)
+        start = key_hash % self.num_slots
+
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, tokens, updated = self._find_slot(key_hash, start)
+
+                if tokens is None:
+                    tokens = burst
+                else:
+                    tokens = min(burst,
+                                 tokens + (now - updated) / seconds_per_token)
+
+                if tokens >= 1:
+                    tokens -= 1
+                    retry_after = 0
+                else:
+                    retry_after = (1 - tokens) * seconds_per_token
+
+                SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+                return retry_after
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find_slot(self, key_hash, start):
+        """(offset, tokens, updated) of the slot for `key_hash`.
+
+        tokens and updated are None if the key had no bucket.
+        """
+
+        oldest = None
+
+        for probe in range(PROBE_WINDOW):
+            offset = ((start + probe) % self.num_slots) * SLOT.size
+            slot_hash, tokens, updated = SLOT.unpack_from(self._map, offset)
+
+            if slot_hash == key_hash:
+                return offset, tokens, updated
+            if slot_hash == 0:
+                return offset, None, None
+            if oldest is None or updated < oldest[1]:
+                oldest = (offset, updated)
+
+        return oldest[0], None, None
+
+
+class LoginThrottle:
+    """Per-username and per-IP limits on login attempts."""
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('LOGIN_THROTTLE_ENABLED', True)
+        app.config.setdefault('LOGIN_THROTTLE_PATH', default_path())
+        app.config.setdefault('LOGIN_THROTTLE_USERNAME', (5, 60))
+        app.config.setdefault('LOGIN_THROTTLE_IP', (20, 6))
+
+    def _table(self, path):
+        with self._lock:
+            if path not in self._tables:
+                self._tables[path] = BucketTable(path)
+            return self._tables[path]
+
+    def check(self, ip, username):
+        """Spend a login attempt for `ip` and `username`.
+
+        Returns 0 if the attempt may go ahead, otherwise the number of
+        seconds to wait before trying again.
+        """
+
+        config = current_app.config
+        if not config['LOGIN_THROTTLE_ENABLED']:
+            return 0
+
+        table = self._table(config['LOGIN_THROTTLE_PATH'])
+
+        return (
+            table.take(f"ip:{ip}", *config['LOGIN_THROTTLE_IP'])
+            or table.take(f"username:{username.lower()}",
+                          *config['LOGIN_THROTTLE_USERNAME'])
+        )
+
+
+login_throttle = LoginThrottle()